@@ -0,0 +1,175 @@
+import aiohttp
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+
+import mock_raiderio
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Offline crawl benchmark: runs parser.py, parser_tournament.py and bot.fetch_guild_data against a local
+# mock raider.io server and reports requests/s, p50/p99 latency, peak RSS and wall time per roster size
+# Usage: python bench_crawl.py --sizes 1000 10000 100000 --latency 0.05 --error-rate 0.01
+
+CRAWLERS = ('parser', 'tournament', 'guilds')
+
+# Function to get a percentile of a list of values
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+# Function to get the peak resident memory of this process in MB, None where it cannot be measured
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+# Function to get a free local port for the mock server
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# Function to wait until the mock server accepts connections
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Mock server did not start on port {port}")
+
+# Function to write a synthetic guild list and sign-up sheet with the given number of characters
+def write_fixtures(size, members_per_guild):
+    with open('uaguildlist.txt', 'w', encoding='utf-8') as file:
+        for i in range(max(1, size // members_per_guild)):
+            file.write(f"region=eu&realm=Tarren Mill&name=Guild {i}\n")
+    with open('sheet.csv', 'w', encoding='utf-8') as file:
+        file.write("Timestamp,Name,Realm,Guild\n")
+        for i in range(size):
+            file.write(f"2025-01-01,Player{i},Tarren Mill,Guild {i // members_per_guild}\n")
+
+# Function to build an aiohttp trace that records the latency of every request
+def latency_trace(latencies):
+    async def on_request_start(session, context, params):
+        context.start = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        latencies.append(time.perf_counter() - context.start)
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    return trace
+
+async def crawl_parser(latencies, options):
+    import parser
+    parser.WORKER_COUNT = options.workers
+    connector = aiohttp.TCPConnector(ssl=False)
+    async with aiohttp.ClientSession(connector=connector, trace_configs=[latency_trace(latencies)]) as session:
+        await parser.crawl(session, parser.read_guild_data('uaguildlist.txt'), [],
+                           output_path='members.json', checkpoint_path='members.ndjson')
+
+async def crawl_tournament(latencies, options):
+    import parser_tournament
+    data_array = parser_tournament.get_data_array('sheet.csv')
+    connector = aiohttp.TCPConnector(ssl=False)
+    async with aiohttp.ClientSession(connector=connector, trace_configs=[latency_trace(latencies)]) as session:
+        await parser_tournament.crawl(session, data_array, output_file_path='tournament.json')
+
+async def crawl_guilds(latencies, options):
+    import bot
+    import raiderio
+    bot.http_client = raiderio.HttpClient(trace_configs=[latency_trace(latencies)])
+    try:
+        await bot.fetch_all_guilds(bot.CURRENT_TIER)
+    finally:
+        await bot.http_client.close()
+
+# Function to run one crawler in a fresh process, so peak RSS belongs to that crawler alone
+def run_case(crawler, size, base_url, options, results):
+    import raiderio
+    raiderio.API_BASE = base_url
+    crawl = {'parser': crawl_parser, 'tournament': crawl_tournament, 'guilds': crawl_guilds}[crawler]
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        write_fixtures(size, options.members_per_guild)
+        sys.stdout = open(os.devnull, 'w')  # The crawlers log every failure, keep the report readable
+
+        latencies = []
+        start_time = time.perf_counter()
+        try:
+            asyncio.run(crawl(latencies, options))
+        except Exception as e:
+            results.put({'crawler': crawler, 'size': size, 'error': repr(e)})
+            return
+        finally:
+            os.chdir(os.path.dirname(directory))
+        wall_time = time.perf_counter() - start_time
+
+    results.put({
+        'crawler': crawler,
+        'size': size,
+        'requests': len(latencies),
+        'wall_time': wall_time,
+        'requests_per_second': len(latencies) / wall_time if wall_time else 0.0,
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'peak_rss': peak_rss_mb(),
+    })
+
+def main():
+    arguments = argparse.ArgumentParser(description="Benchmark the crawlers against a local mock raider.io server")
+    arguments.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="Characters per synthetic roster")
+    arguments.add_argument('--crawlers', nargs='+', choices=CRAWLERS, default=list(CRAWLERS))
+    arguments.add_argument('--members-per-guild', type=int, default=50)
+    arguments.add_argument('--workers', type=int, default=8, help="Character workers used by parser.py")
+    arguments.add_argument('--latency', type=float, default=0.02, help="Mean seconds the mock adds to every response")
+    arguments.add_argument('--error-rate', type=float, default=0.0, help="Share of requests the mock answers with a 503")
+    arguments.add_argument('--rate-limit', type=float, default=0, help="Requests per second before the mock answers with a 429")
+    options = arguments.parse_args()
+
+    port = free_port()
+    server = multiprocessing.Process(target=mock_raiderio.run, kwargs={
+        'port': port,
+        'members_per_guild': options.members_per_guild,
+        'latency': options.latency,
+        'error_rate': options.error_rate,
+        'rate_limit': options.rate_limit,
+    }, daemon=True)
+    server.start()
+    try:
+        wait_for_port(port)
+        print(f"{'crawler':<12}{'size':>8}{'requests':>10}{'wall s':>10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'peak RSS MB':>13}")
+        for size in options.sizes:
+            for crawler in options.crawlers:
+                results = multiprocessing.Queue()
+                case = multiprocessing.Process(target=run_case, args=(crawler, size, f"http://127.0.0.1:{port}", options, results))
+                case.start()
+                result = results.get()
+                case.join()
+                if 'error' in result:
+                    print(f"{crawler:<12}{size:>8}  failed: {result['error']}")
+                    continue
+                rss = "n/a" if result['peak_rss'] is None else f"{result['peak_rss']:.1f}"
+                print(f"{crawler:<12}{size:>8}{result['requests']:>10}{result['wall_time']:>10.2f}"
+                      f"{result['requests_per_second']:>10.1f}{result['p50']:>10.1f}{result['p99']:>10.1f}{rss:>13}")
+    finally:
+        server.terminate()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import argparse
+import itertools
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import snapshot
+from mock_raiderio import synthetic_character
+from queries import QueryError, rank_query, tournament_query
+
+# Synthetic-load benchmark for the /rank and /tournament query paths: generates members.json files of growing size,
+# times loading them (as JSON and as the memory-mapped binary snapshot) and answering every combination of the command filters
+# Usage: python bench_queries.py --sizes 1000 10000 100000 500000 --repeat 5
+
+GUILDS_PER_SNAPSHOT = 80  # Roughly the number of guilds in uaguildlist.txt
+NO_GUILD_SHARE = 0.05  # Share of members without a guild, like the extra characters of parser.py
+
+# Filter values tried for every query, each combination is timed
+RANK_TOPS = (10, 50)
+RANK_GUILDS = ("all", "Guild 0", "Guild 0, Guild 1, Guild 2, None")
+RANK_CLASSES = ("all", "mage", "death knight:3")
+RANK_ROLES = ("all", "dps", "healer", "tank")
+RANK_RIOS = (0, 2000, 3000)
+TOURNAMENT_GUILDS = ("Guild 0", "None")
+TOURNAMENT_TOPS = (5, 20)
+TOURNAMENT_FORMATS = ("new", "old")
+
+# Function to build the members.json record of a synthetic character, shaped like the output of parser.py
+def synthetic_member(i):
+    character = synthetic_character("Tarren Mill", f"Player{i}")
+    scores = character['mythic_plus_scores_by_season'][0]['scores']
+    guild = None if i % round(1 / NO_GUILD_SHARE) == 0 else f"Guild {i % GUILDS_PER_SNAPSHOT}"
+    return {
+        'name': character['name'],
+        'realm': character['realm'],
+        'guild': guild,
+        'class': character['class'],
+        'active_spec_name': character['active_spec_name'],
+        'rio_all': scores['all'],
+        'rio_dps': scores['dps'],
+        'rio_healer': scores['healer'],
+        'rio_tank': scores['tank'],
+        **{f'spec_{spec}': scores[f'spec_{spec}'] for spec in range(4)},
+    }
+
+# Function to write a synthetic members.json with the given number of members
+def write_snapshot(path, size):
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump([synthetic_member(i) for i in range(size)], file, ensure_ascii=False, indent=2)
+
+# Function to time a call, returns the mean seconds over the repeats
+def time_call(repeat, func, *args):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        try:
+            func(*args)
+        except QueryError:
+            pass  # Empty results are timed too, the bot answers them as well
+    return (time.perf_counter() - start_time) / repeat
+
+# Function to time every filter combination of both commands against one snapshot
+def time_queries(snapshot, repeat):
+    timings = []
+    for top, guilds, classes, role, rio in itertools.product(RANK_TOPS, RANK_GUILDS, RANK_CLASSES, RANK_ROLES, RANK_RIOS):
+        query = f"rank top={top} guilds={guilds} classes={classes} role={role} rio={rio}"
+        timings.append((query, time_call(repeat, rank_query, snapshot, top, classes, guilds, role, rio)))
+    for guild, top, format in itertools.product(TOURNAMENT_GUILDS, TOURNAMENT_TOPS, TOURNAMENT_FORMATS):
+        query = f"tournament guild={guild} top={top} format={format}"
+        timings.append((query, time_call(repeat, tournament_query, snapshot, guild, top, format)))
+    return timings
+
+def main():
+    arguments = argparse.ArgumentParser(description="Benchmark the /rank and /tournament queries on synthetic snapshots")
+    arguments.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 500000], help="Members per synthetic snapshot")
+    arguments.add_argument('--repeat', type=int, default=5, help="Times each query is run, the mean is reported")
+    arguments.add_argument('--slowest', type=int, default=5, help="Slowest queries listed per size")
+    arguments.add_argument('--all', action='store_true', help="List the time of every query combination")
+    arguments.add_argument('--python', action='store_true', help="Query through the Python indexes even when NumPy is installed")
+    options = arguments.parse_args()
+
+    if options.python:
+        snapshot.COLUMNAR_MIN_MEMBERS = float('inf')
+
+    print(f"{'size':>8}{'file MB':>10}{'load s':>10}{'bin MB':>10}{'bin load s':>12}{'queries':>9}{'p50 ms':>10}{'mean ms':>10}{'max ms':>10}")
+    reports = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in options.sizes:
+            path = os.path.join(directory, f"members_{size}.json")
+            write_snapshot(path, size)
+
+            start_time = time.perf_counter()
+            members = snapshot.MemberStore().load(path)
+            load_time = time.perf_counter() - start_time
+
+            # Queries run against the binary snapshot, which is what the bot maps once the parsers wrote it
+            snapshot.publish_binary_snapshot(path, members.members)
+            binary = snapshot.latest_binary(path)
+            del members
+            start_time = time.perf_counter()
+            members = snapshot.MemberStore().load(path)
+            binary_load_time = time.perf_counter() - start_time
+
+            timings = time_queries(members, options.repeat)
+            seconds = [timing for _, timing in timings]
+            print(f"{size:>8}{os.path.getsize(path) / (1024 * 1024):>10.1f}{load_time:>10.2f}"
+                  f"{os.path.getsize(binary) / (1024 * 1024):>10.1f}{binary_load_time:>12.3f}{len(timings):>9}"
+                  f"{statistics.median(seconds) * 1000:>10.3f}{statistics.mean(seconds) * 1000:>10.3f}{max(seconds) * 1000:>10.3f}")
+            reports.append((size, timings))
+
+            # Free the snapshot before the next size is generated
+            del members
+            os.remove(path)
+            os.remove(binary)
+
+    for size, timings in reports:
+        listed = timings if options.all else sorted(timings, key=lambda timing: timing[1], reverse=True)[:options.slowest]
+        print(f"\n{size} members, {'all' if options.all else 'slowest'} queries:")
+        for query, timing in listed:
+            print(f"{timing * 1000:>10.3f} ms  {query}")
+
+if __name__ == "__main__":
+    main()
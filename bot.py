@@ -1,14 +1,141 @@
-import json
 import discord
-import aiohttp
 import asyncio
+import os
 import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from discord import app_commands
-from config import token
+
+import fastjson
+import metrics
+import parser
+import parser_tournament
+import raiderio
+from queries import GUILD_STATS_SORTS, PrefixIndex, QueryError, TOURNAMENT_SOURCES, class_options, guild_options, guild_stats, guildstats_query, rank_key, rank_leaders, rank_message, tournament_query
+from snapshot import MemberStore
+
+# /guilds result cache settings
+CURRENT_TIER = 3
+TIER_RAIDS = {1: "nerubar-palace", 2: "liberation-of-undermine", 3: "manaforge-omega"}  # Season -> raid slug, other seasons are rejected
+GUILDS_REFRESH_INTERVAL = 15 * 60  # Seconds between background refreshes of the cached tiers
+GUILDS_MAX_AGE = 60 * 60  # Cached results older than this are fetched again before replying
+
+# Background crawl settings, the crawls rebuild the snapshots the commands read
+MEMBERS_PATH = TOURNAMENT_SOURCES['old'][0]  # Written by the parser.py crawl, read by /rank and /tournament format=old
+TOURNAMENT_PATH = TOURNAMENT_SOURCES['new'][0]  # Written by the parser_tournament.py crawl
+MEMBERS_CHECKPOINT_PATH = 'members.ndjson'
+TOURNAMENT_STATE_PATH = 'tournament_state.json'  # Lets a tournament crawl fetch only new, changed and stale sign-ups
+ADDITIONAL_CHARACTERS_PATH = 'addCharacters.txt'
+MEMBERS_CRAWL_INTERVAL = 6 * 60 * 60  # Seconds between crawls, a snapshot younger than this is not crawled again on startup
+TOURNAMENT_CRAWL_INTERVAL = 60 * 60
+CRAWL_BUDGET_SHARE = 0.5  # Share of the raider.io quota the crawls may use, the rest stays for the commands
+
+# Guild role request handled by on_message
+TRIGGER_CHANNEL = "флудилка"  # Only channels with this in their name are checked
+TRIGGER_PATTERN = re.compile(re.escape("видайте мені роль члена гільдії"), re.IGNORECASE)
+NAME_PATTERN = re.compile(r"[|/(\[]")  # Nicknames of guild members carry a guild tag
+REQUIRED_ROLE = "Guest"
+SKIPPED_ROLE = "guild member"
+
+RANK_CACHE_SIZE = 256  # /rank results kept in memory, the least recently used are dropped first
+AUTOCOMPLETE_LOAD_TIMEOUT = 1.5  # Seconds autocomplete waits for a changed snapshot, Discord drops answers after 3
+
+# Metrics shown by /stats are also dumped to this file in the Prometheus text format
+METRICS_PATH = 'metrics.prom'
+METRICS_DUMP_INTERVAL = 60  # Seconds between dumps
+
+# Event loop lag monitor, discord.py misses gateway heartbeats while a callback blocks the loop
+LOOP_LAG_INTERVAL = 0.5  # Seconds between checks
+LOOP_LAG_THRESHOLD = 0.25  # Seconds of lag that get logged
+
+# Pooled HTTP client shared by all commands, created in on_ready
+http_client = None
+
+# Cached guild data per tier: tier -> (fetched_at, guilds)
+guild_cache = {}
+guild_refresh_task = None
+
+# Background crawls, started in on_ready
+crawl_limiter = None
+crawl_cache = None
+crawl_tasks = []
+metrics_task = None
+loop_lag_task = None
+
+# Runs concurrent identical work once, every caller awaits the same in-progress task
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.coalesced = 0  # Callers that joined work already in progress
+
+    async def run(self, key, func, *args):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            self.coalesced += 1
+        # Shield the shared task so one cancelled caller does not cancel it for the others
+        return await asyncio.shield(task)
+
+single_flight = SingleFlight()
+
+# Least recently used cache of query results
+class ReplyCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.replies = OrderedDict()  # Key -> query result
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        result = self.replies.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.replies.move_to_end(key)
+        return result
+
+    def put(self, key, result):
+        self.replies[key] = result
+        self.replies.move_to_end(key)
+        while len(self.replies) > self.max_size:
+            self.replies.popitem(last=False)
+
+rank_cache = ReplyCache(RANK_CACHE_SIZE)
+
+# Autocomplete indexes of the /rank arguments, the guild index is rebuilt for every new members snapshot
+class_index = PrefixIndex(class_options())
+guild_index = None  # (snapshot version, index)
+
+# Per-guild statistics of /guildstats, computed once for every new members snapshot
+guild_stats_cache = None  # (snapshot version, statistics)
+
+# Role IDs per guild for on_message: guild id -> (required role id, skipped role id), None if the guild lacks the role
+guild_roles = {}
+
+# Snapshots of members.json and tournament.json kept in memory between commands
+# A JSON snapshot is decoded in a worker process into a binary snapshot first, the event loop keeps the GIL meanwhile
+member_store = MemberStore(ProcessPoolExecutor(max_workers=1))
+
+# Client that also closes the shared HTTP client on shutdown
+class Bot(discord.Client):
+    async def close(self):
+        for task in crawl_tasks:
+            task.cancel()
+        if crawl_cache is not None:
+            crawl_cache.close()
+        if http_client is not None:
+            await http_client.close()
+        member_store.executor.shutdown(wait=False, cancel_futures=True)
+        await super().close()
 
 # Initialize intents and client
 intents = discord.Intents.all()
-client = discord.Client(intents=intents)
+client = Bot(intents=intents)
 tree = app_commands.CommandTree(client)
 
 # Function to read guild data from the file
@@ -21,17 +148,52 @@ def read_guild_data(file_path='uaguildlist.txt'):
         print(f"An error occurred while reading guild data: {e}")
         return []
 
+# Asynchronous function to get a snapshot, the file is read again only after it changes
+async def load_snapshot(data_file):
+    snapshot = member_store.cached(data_file)
+    if snapshot is not None:
+        metrics.increment('snapshot_requests_total', result='cached')
+        return snapshot
+    metrics.increment('snapshot_requests_total', result='loaded')
+    # Concurrent reloads of the same file share one read
+    return await single_flight.run(('snapshot', data_file), asyncio.to_thread, member_store.load, data_file)
+
+# Asynchronous function to get the guild autocomplete index: guilds of the members snapshot and of uaguildlist.txt
+# A snapshot that takes too long to load keeps loading in the background, the index of the previous one answers meanwhile
+async def get_guild_index():
+    global guild_index
+    try:
+        snapshot = await asyncio.wait_for(load_snapshot(MEMBERS_PATH), AUTOCOMPLETE_LOAD_TIMEOUT)
+    except asyncio.TimeoutError:
+        snapshot = member_store.snapshots.get(MEMBERS_PATH)
+    except (OSError, ValueError):
+        snapshot = None  # No snapshot yet, the guild list alone is completed
+    version = snapshot.version if snapshot is not None else None
+    if guild_index is None or guild_index[0] != version:
+        guild_names = {parser.guild_key(entry)[2] for entry in read_guild_data()}
+        if snapshot is not None:
+            guild_names |= snapshot.guild_names
+        guild_index = (version, PrefixIndex(guild_options(sorted(guild_names - {""}))))
+    return guild_index[1]
+
+# Asynchronous function to get the /guildstats statistics of the members snapshot, computed in a worker thread once per snapshot
+async def get_guild_stats():
+    global guild_stats_cache
+    snapshot = await load_snapshot(MEMBERS_PATH)
+    if guild_stats_cache is None or guild_stats_cache[0] != snapshot.version:
+        # Concurrent commands after a reload share one computation
+        with metrics.timer('guild_stats_seconds'):
+            stats = await single_flight.run(('guild_stats', snapshot.version), asyncio.to_thread, guild_stats, snapshot)
+        guild_stats_cache = (snapshot.version, stats)
+    return guild_stats_cache[1]
+
 # Asynchronous function to fetch guild data
+@metrics.timed('guild_fetch_seconds')
 async def fetch_guild_data(guild_url, tier):
-    prefix = "http://raider.io/api/v1/guilds/profile?"
+    prefix = f"{raiderio.API_BASE}/api/v1/guilds/profile?"
     postfix = "&fields=raid_rankings,raid_progression"
     
-    switch_dict = {
-        1: "nerubar-palace",
-        2: "liberation-of-undermine",
-        3: "manaforge-omega"
-    }
-    raid = switch_dict.get(tier)
+    raid = TIER_RAIDS.get(tier)
     
     current_bosses_names = {
         1: "plexus-sentinel",
@@ -51,65 +213,63 @@ async def fetch_guild_data(guild_url, tier):
     }
 
     try:
-        async with aiohttp.ClientSession() as session:            
-            async with session.get(prefix + guild_url + postfix, ssl=False) as response:
-                json_data = await response.json()
-
-                if not all(key in json_data for key in ['name', 'realm', 'raid_progression', 'raid_rankings']):
-                    print(f"Invalid API response format for {guild_url}: {json_data}")
-                    return None
-
-                guild_name = json_data['name']
-                guild_realm = json_data['realm']
-                guild_progress = json_data['raid_progression'][raid].get('summary', '0/0 N')
-                guild_rank = json_data['raid_rankings'][raid]['mythic'].get('world', None)
-                
-                best_percent = 100.0
-                pull_count = 0
+        async with http_client.get(prefix + guild_url + postfix) as response:
+            json_data = await fastjson.read_json(response)
+
+        if not all(key in json_data for key in ['name', 'realm', 'raid_progression', 'raid_rankings']):
+            print(f"Invalid API response format for {guild_url}: {json_data}")
+            return None
+
+        guild_name = json_data['name']
+        guild_realm = json_data['realm']
+        guild_progress = json_data['raid_progression'][raid].get('summary', '0/0 N')
+        guild_rank = json_data['raid_rankings'][raid]['mythic'].get('world', None)
+        
+        best_percent = 100.0
+        pull_count = 0
+        
+        try:
+            current_progress = int(guild_progress.split("/")[0])
+            if current_progress < 8:
+                next_boss = current_bosses_names.get(current_progress + 1)
+                if not next_boss:
+                    raise ValueError("Invalid boss number")
+                 
+                region, realm, guild = guild_url.split("&")
+                formatted_region = region.replace("region=", "")
+                formatted_realm = realm.replace("%20", "-").replace("realm=", "")
+                formatted_guild = guild.replace("name=", "guild=")
                 
-                try:
-                    current_progress = int(guild_progress.split("/")[0])
-                    if current_progress < 8:
-                        next_boss = current_bosses_names.get(current_progress + 1)
-                        if not next_boss:
-                            raise ValueError("Invalid boss number")
-                         
-                        region, realm, guild = guild_url.split("&")
-                        formatted_region = region.replace("region=", "")
-                        formatted_realm = realm.replace("%20", "-").replace("realm=", "")
-                        formatted_guild = guild.replace("name=", "guild=")
-                        
-                        difficulty = guild_progress[-1]
-                        boss_kill_url = (
-                            f"https://raider.io/api/guilds/boss-kills?raid={raid}"
-                            f"{boss_kill_url_suffix.get(difficulty, '')}&region={formatted_region}&realm={formatted_realm}&{formatted_guild}&boss={next_boss}"
-                        )
-                        
-                        async with session.get(boss_kill_url, ssl=False) as boss_response:
-                            if boss_response.status != 422:                                  
-                                boss_data = await boss_response.json()
-                                kill_details = boss_data.get('killDetails', {}).get('attempt', {})
-                                best_percent = kill_details.get('bestPercent', 100.0)
-                                pull_count = kill_details.get('pullCount', 0)                            
-                except Exception as e:
-                    print(f"Error processing guild progress for {guild_name}: {e}")
+                difficulty = guild_progress[-1]
+                boss_kill_url = (
+                    f"{raiderio.API_BASE}/api/guilds/boss-kills?raid={raid}"
+                    f"{boss_kill_url_suffix.get(difficulty, '')}&region={formatted_region}&realm={formatted_realm}&{formatted_guild}&boss={next_boss}"
+                )
                 
-                return {                    
-                    "name": guild_name,
-                    "realm": guild_realm,
-                    "progress": guild_progress,
-                    "rank": guild_rank,
-                    "best_percent": best_percent,
-                    "pull_count": pull_count
-                }
+                async with http_client.get(boss_kill_url) as boss_response:
+                    if boss_response.status != 422:                                  
+                        boss_data = await fastjson.read_json(boss_response)
+                        kill_details = boss_data.get('killDetails', {}).get('attempt', {})
+                        best_percent = kill_details.get('bestPercent', 100.0)
+                        pull_count = kill_details.get('pullCount', 0)                            
+        except Exception as e:
+            print(f"Error processing guild progress for {guild_name}: {e}")
+        
+        return {                    
+            "name": guild_name,
+            "realm": guild_realm,
+            "progress": guild_progress,
+            "rank": guild_rank,
+            "best_percent": best_percent,
+            "pull_count": pull_count
+        }
 
     except Exception as e:
         print(f"An error occurred while fetching guild data for {guild_url}: {e}")
         return None
 
-# Function to send long messages in chunks
-async def send_long_message(interaction, message, chunk_size=2000):
-    # Split the message into chunks of the specified size
+# Function to split a message into chunks of whole lines no longer than the chunk size
+def split_message(message, chunk_size=2000):
     message_chunks = []
     current_chunk = ""
 
@@ -121,21 +281,125 @@ async def send_long_message(interaction, message, chunk_size=2000):
     
     if current_chunk:
         message_chunks.append(current_chunk)
+    return message_chunks
+
+# Asynchronous function to send a long message in chunks
+async def send_long_message(interaction, message, chunk_size=2000):
+    await send_chunks(interaction, split_message(message, chunk_size))
 
-    # Send each chunk
+# Asynchronous function to send each chunk as a follow-up message
+async def send_chunks(interaction, message_chunks, ephemeral=False):
     for chunk in message_chunks:
-        await interaction.followup.send(chunk)
+        await interaction.followup.send(chunk, ephemeral=ephemeral)
        
+# Asynchronous function to fetch data for all guilds of a tier, concurrent refreshes of a tier share one fan-out
+async def refresh_guild_cache(tier):
+    return await single_flight.run(('guilds', tier), fetch_all_guilds, tier)
+
+# Asynchronous function to fetch data for all guilds of a tier and store it in the cache
+async def fetch_all_guilds(tier):
+    url_list = read_guild_data()
+    guilds = await asyncio.gather(*[fetch_guild_data(guild_url, tier) for guild_url in url_list])
+    guilds = [guild for guild in guilds if guild]
+    print(http_client.summary())
+
+    # Keep serving the previous data if raider.io returned nothing this time
+    if guilds or tier not in guild_cache:
+        guild_cache[tier] = (time.time(), guilds)
+    return guild_cache[tier]
+
+# Asynchronous function to get guild data for a tier, fetching it only when the cached copy is too old
+async def get_guild_data(tier, force_refresh=False):
+    if tier not in TIER_RAIDS:
+        raise ValueError(f"Unknown season: {tier}")
+    cached = guild_cache.get(tier)
+    if force_refresh or cached is None or time.time() - cached[0] > GUILDS_MAX_AGE:
+        cached = await refresh_guild_cache(tier)
+    return cached
+
+# Background task that keeps every cached tier fresh
+async def refresh_guild_cache_loop():
+    while True:
+        for tier in [tier for tier in guild_cache if tier in TIER_RAIDS] or [CURRENT_TIER]:
+            try:
+                await refresh_guild_cache(tier)
+            except Exception as e:
+                print(f"An error occurred while refreshing guild data for tier {tier}: {e}")
+        await asyncio.sleep(GUILDS_REFRESH_INTERVAL)
+
+# Asynchronous function to crawl the guild rosters into the members snapshot
+async def crawl_members():
+    await parser.crawl(
+        http_client.session, read_guild_data(), parser.read_additional_characters(ADDITIONAL_CHARACTERS_PATH),
+        crawl_limiter, crawl_cache, output_path=MEMBERS_PATH, checkpoint_path=MEMBERS_CHECKPOINT_PATH
+    )
+
+# Asynchronous function to crawl the tournament sign-up sheet into the tournament snapshot
+async def crawl_tournament():
+    data_array = await asyncio.to_thread(parser_tournament.get_data_array, parser_tournament.SHEET_URL)
+    await parser_tournament.crawl(http_client.session, data_array, crawl_cache, TOURNAMENT_PATH, crawl_limiter, TOURNAMENT_STATE_PATH)
+
+# Background task that runs a crawl every interval and loads the snapshot it wrote
+async def crawl_loop(name, crawl, path, interval):
+    while True:
+        # A snapshot written recently, by this bot or by hand, is not crawled again right away
+        age = time.time() - os.path.getmtime(path) if os.path.exists(path) else interval
+        await asyncio.sleep(max(0, interval - age))
+
+        start_time = time.time()
+        print(f"Starting the {name} crawl")
+        try:
+            await crawl()
+            # The crawl replaced the file at once, load it now so no command waits for the reload
+            await load_snapshot(path)
+            if path == MEMBERS_PATH:
+                await get_guild_stats()  # The first /guildstats after the crawl does not wait for the statistics either
+            print(f"The {name} crawl finished in {time.time() - start_time:.0f} seconds")
+        except Exception as e:
+            print(f"An error occurred during the {name} crawl: {e}")
+            # Wait a full interval before trying again instead of retrying at once
+            await asyncio.sleep(interval)
+
+# Background task that dumps the metrics to a file for Prometheus-style scrapers
+async def write_metrics_loop():
+    while True:
+        await asyncio.sleep(METRICS_DUMP_INTERVAL)
+        try:
+            metrics.write_prometheus(METRICS_PATH)
+        except Exception as e:
+            print(f"An error occurred while writing the metrics: {e}")
+
+# Background task that measures how late the event loop wakes it up, a late wake-up means something blocked the loop
+async def monitor_loop_lag():
+    loop = asyncio.get_running_loop()
+    # With PYTHONASYNCIODEBUG=1 asyncio also logs the callback that blocked for longer than this
+    loop.slow_callback_duration = LOOP_LAG_THRESHOLD
+    while True:
+        start_time = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = loop.time() - start_time - LOOP_LAG_INTERVAL
+        metrics.observe('event_loop_lag_seconds', lag)
+        if lag > LOOP_LAG_THRESHOLD:
+            print(f"The event loop was blocked for {lag:.3f} seconds")
+
 # Function to print guild ranks
-async def print_guild_ranks(interaction, tier, limit):
+async def print_guild_ranks(interaction, tier, limit, refresh=False):
     try:
+        # Only administrators may bypass the cache
+        if refresh and not getattr(getattr(interaction.user, 'guild_permissions', None), 'administrator', False):
+            await interaction.response.send_message("Only administrators can force a refresh.", ephemeral=True)
+            return
+
+        # An unknown season would fetch every guild for nothing and stay in the cache
+        if tier not in TIER_RAIDS:
+            await interaction.response.send_message(f"Season {tier} does not exist. Use one of the seasons: {', '.join(map(str, TIER_RAIDS))}.", ephemeral=True)
+            return
+
         # Defer the response to indicate that the bot is processing the request
         await interaction.response.defer()
 
-        # Asynchronously get data for all guilds of the specified tier
-        url_list = read_guild_data()
-        guilds = await asyncio.gather(*[fetch_guild_data(guild_url, tier) for guild_url in url_list])
-        guilds = [guild for guild in guilds if guild]
+        # Get data for all guilds of the specified tier, served from the cache when it is fresh enough
+        fetched_at, guilds = await get_guild_data(tier, refresh)
 
         if not guilds:
             await interaction.followup.send(f"At the moment, there are no guilds with progression in the {tier} season.")
@@ -170,6 +434,9 @@ async def print_guild_ranks(interaction, tier, limit):
             # Join all parts into a single line
             formatted_guilds.append(", ".join(guild_info))
 
+        # Show how old the cached data is
+        formatted_guilds.append(f"\nData updated {int((time.time() - fetched_at) // 60)} min ago")
+
         # Send the formatted guilds using send_long_message
         await send_long_message(interaction, "\n".join(formatted_guilds))
 
@@ -184,10 +451,12 @@ async def print_guild_ranks(interaction, tier, limit):
 @tree.command(name="guilds", description="Guilds Raid Rank")
 @app_commands.describe(
     season="1/2/3",
-    limit="Number of guilds to display (or 'all' for full list)"
+    limit="Number of guilds to display (or 'all' for full list)",
+    refresh="Fetch fresh data instead of the cached one (administrators only)"
 )
-async def get_data(interaction, season: int = 3, limit: str = '10'):
-    await print_guild_ranks(interaction, season, limit)
+@metrics.timed('command_seconds', command='guilds')
+async def get_data(interaction, season: int = CURRENT_TIER, limit: str = '10', refresh: bool = False):
+    await print_guild_ranks(interaction, season, limit, refresh)
 
 # Command to print player ranks in the current M+ season
 @tree.command(name="rank", description="Guilds Mythic+ Rank")
@@ -198,185 +467,110 @@ async def get_data(interaction, season: int = 3, limit: str = '10'):
     role="all/dps/healer/tank", 
     rio="0-3500"
 )
+@metrics.timed('command_seconds', command='rank')
 async def rank(interaction, top: int = 10, classes: str = "all", guilds: str = "all", role: str = "all", rio: int = 2000):
     try:
         # Defer the response to indicate processing
         await interaction.response.defer()
 
-        # Read data from the JSON file
-        with open('members.json', 'r', encoding='utf-8') as file:
-            members_data = json.load(file)
-
-        # Checking the existence of data in the file
-        if not members_data:
-            await interaction.followup.send("No data to process. Complete the 'members.json' file before using this command.")
-            return
-
-        # Check for valid guild
-        if guilds.lower() != "all":
-            input_guilds = [g.strip().lower() for g in guilds.split(',')]
-            members_data = [
-                member for member in members_data
-                if (
-                    (member.get('guild') is None and 'none' in input_guilds) or
-                    ((member.get('guild') or "").lower() in input_guilds)
-                )
-            ]
-            if not members_data:
-                await interaction.followup.send(
-                    "No members found for the given guild(s). Check the spelling or try different values."
-                )
-                return
-        
-        # Check for valid class
-        spec_number = 0
-        valid_classes = {"all", "death knight", "demon hunter", "druid", "evoker", "hunter", "mage", "monk", "paladin", "priest", "rogue", "shaman", "warlock", "warrior"}
-        if ':' in classes.lower():
-            split_result = classes.split(':')            
-            if len(split_result) == 2 and split_result[1].isdigit() and 1 <= int(split_result[1]) <= 4:
-                classes = split_result[0]
-                spec_number = int(split_result[1])                
-                role = "all"
-            else:
-                await interaction.followup.send("Wrong class format. Use the valid format: death knight:3 or warrior:1.")
+        # Read data from the JSON file and answer the query, repeated queries on the same data reuse the members found
+        snapshot = await load_snapshot(MEMBERS_PATH)
+        key = (rank_key(top, classes, guilds, role, rio), snapshot.version)
+        leaders = rank_cache.get(key)
+        if leaders is None:
+            try:
+                # Filtering and sorting run in a worker thread so the event loop keeps serving the gateway
+                leaders = await asyncio.to_thread(rank_leaders, snapshot, top, classes, guilds, role, rio)
+            except QueryError as e:
+                await interaction.followup.send(str(e))
                 return
-        else:            
-            if (classes or "").lower() not in valid_classes:
-                await interaction.followup.send(f"Class '{classes}' does not exist. Use the valid classes: all, death knight, demon hunter, druid, evoker, hunter, mage, monk, paladin, priest, rogue, shaman, warlock, warrior.")
-                return        
-
-        # Check for valid role
-        valid_roles = {"all", "dps", "healer", "tank"}
-        if role.lower() not in valid_roles:
-            await interaction.followup.send(f"Role '{role}' does not exist. Use the valid roles: all, dps, healer, tank or spec name.")
-            return
-
-        # Check if top value is within the range of 1 to 50 inclusive
-        if not 1 <= top <= 50:
-            await interaction.followup.send("Error: The value of top must be between 1 and 50 inclusive.")
-            return
-            
-        # Check if rio value is within the range of 0 to 3500 inclusive
-        if not 0 <= rio <= 3500:
-            await interaction.followup.send("Error: The value of rio must be between 0 and 3500 inclusive.")
-            return
+            rank_cache.put(key, leaders)
 
-        # Filter by class        
-        if (classes or "").lower() != "all":
-            members_data = [member for member in members_data if (member.get('class') or "").lower() == classes.lower()]
+        # The reply is formatted for every query, so it shows the arguments as this user wrote them
+        await send_chunks(interaction, split_message(rank_message(leaders, top, classes, guilds, role, rio)))
 
-        # Check whether the specification is entered
-        if spec_number == 0:
-            # Sort by RIO rating according to the role
-            if role.lower() != "all":
-                members_data = sorted(members_data, key=lambda x: max(x.get('rio_' + role.lower(), 0), 0), reverse=True)
-            else:
-                members_data = sorted(members_data, key=lambda x: max(x.get('rio_all', 0), 0), reverse=True)
-
-            # Filter by rio
-            members_data = [member for member in members_data if max(member.get('rio_' + role.lower(), 0), 0) > rio]
-        else:
-            spec = str(spec_number - 1)
-            # Sort by RIO rating according to the role
-            members_data = sorted(members_data, key=lambda x: max(x.get('spec_' + spec, 0), 0), reverse=True)
-
-            # Filter by rio
-            members_data = [member for member in members_data if max(member.get('spec_' + spec, 0), 0) > rio]
+    except Exception as e:
+        print(f"An error occurred while processing the rank command: {e}")
+        await interaction.followup.send("An error occurred while processing the command. Please try again later.")
+            
+# Autocomplete of the /rank guilds, only the guild after the last comma is completed
+@rank.autocomplete('guilds')
+@metrics.timed('autocomplete_seconds', argument='guilds')
+async def rank_guilds_autocomplete(interaction, current: str):
+    entered, _, last = current.rpartition(',')
+    entered = f"{entered.strip()}, " if entered.strip() else ""
+    index = await get_guild_index()
+    return [
+        app_commands.Choice(name=entered + name, value=entered + value)
+        for name, value in index.complete(last)
+        if len(entered + name) <= 100  # Longest option Discord accepts
+    ]
 
-        # Limit the number of displayed results
-        members_data = members_data[:top]
+# Autocomplete of the /rank classes, class:spec options are named with the spec
+@rank.autocomplete('classes')
+@metrics.timed('autocomplete_seconds', argument='classes')
+async def rank_classes_autocomplete(interaction, current: str):
+    return [app_commands.Choice(name=name, value=value) for name, value in class_index.complete(current)]
 
-        # Format header message
-        header_message = f"Top {top} | Classes -> {classes} | Guilds -> {guilds} | Role -> {role} | Rio > {rio}"
+# Command to compare the guilds, or show one guild, by the statistics of their members
+@tree.command(name="guildstats", description="Guilds Mythic+ statistics")
+@app_commands.describe(
+    guild="all/Нехай Щастить/... 'all' compares every guild.",
+    sort=f"{'/'.join(GUILD_STATS_SORTS)}, the order of the 'all' comparison."
+)
+@metrics.timed('command_seconds', command='guildstats')
+async def guildstats(interaction, guild: str = "all", sort: str = "median"):
+    try:
+        # Defer the response to indicate processing
+        await interaction.response.defer()
 
-        # Format and send the results
-        if spec_number == 0:
-            result_message = "\n".join([f"{i + 1}. {member['name']} ({member['guild']}, {member['realm']}) - {member['active_spec_name']} {member['class']} - RIO {role}: {member['rio_' + role.lower()]}" for i, member in enumerate(members_data)])
-        else:
-            result_message = "\n".join([f"{i + 1}. {member['name']} ({member['guild']}, {member['realm']}) - {member['active_spec_name']} {member['class']} - RIO {role}: {member['spec_' + spec]}" for i, member in enumerate(members_data)])
+        # The statistics were computed when the snapshot was loaded, only the reply is formatted here
+        stats = await get_guild_stats()
+        try:
+            message = guildstats_query(stats, guild, sort)
+        except QueryError as e:
+            await interaction.followup.send(str(e))
+            return
 
-        # Send the follow-up message after the processing is done
-        await send_long_message(interaction, header_message + "\n------------------------------------------------------------\n" + result_message)
+        await send_chunks(interaction, split_message(message))
 
     except Exception as e:
-        print(f"An error occurred while processing the rank command: {e}")
+        print(f"An error occurred while processing the guildstats command: {e}")
         await interaction.followup.send("An error occurred while processing the command. Please try again later.")
-            
+
+# Autocomplete of the /guildstats guild, from the same index as the /rank guilds
+@guildstats.autocomplete('guild')
+@metrics.timed('autocomplete_seconds', argument='guild')
+async def guildstats_guild_autocomplete(interaction, current: str):
+    index = await get_guild_index()
+    return [app_commands.Choice(name=name, value=value) for name, value in index.complete(current)]
+
 @tree.command(name="tournament", description="Get top players in a guild for a tournament")
 @app_commands.describe(
     guild="Guild name for the tournament",
     top="Number of players to display (default: 5)",
     format="Data source format: new or old (default: new)"
 )
+@metrics.timed('command_seconds', command='tournament')
 async def tournament(interaction, guild: str = "Нехай Щастить", top: int = 5, format: str = "new"):
     # Determine the data source based on the 'format' parameter
-    if format == "new":
-        data_file = 'tournament.json'
-        filter_guild = False
-    elif format == "old":
-        data_file = 'members.json'
-        filter_guild = True
-    else:
+    if format not in TOURNAMENT_SOURCES:
         await interaction.response.send_message("Invalid format. Please use 'new' or 'old'.", ephemeral=True)
         return
 
-    # Read data from the selected JSON file
-    with open(data_file, 'r', encoding='utf-8') as file:
-        members_data = json.load(file)
-
-    # Checking the existence of data in the file
-    if not members_data:
-        await interaction.response.send_message(f"No data to process in '{data_file}'.", ephemeral=True)
+    # Read data from the selected JSON file and answer the query
+    snapshot = await load_snapshot(TOURNAMENT_SOURCES[format][0])
+    try:
+        header_message, result_messages = await asyncio.to_thread(tournament_query, snapshot, guild, top, format)
+    except QueryError as e:
+        await interaction.response.send_message(str(e), ephemeral=True)
         return
 
-    if filter_guild:
-        # Filter by guild if needed
-        guild_members = [member for member in members_data if member['guild'].lower() == guild.lower()]
-
-        if not guild_members:
-            await interaction.response.send_message(f"No data available for the guild '{guild}'.", ephemeral=True)
-            return
-    else:
-        # Use all members from the file
-        guild_members = members_data
-
-    # Define desired specs for melee and ranged DPS
-    melee_specs = ["frost", "unholy", "havoc", "feral", "survival", "windwalker", "retribution", "assassination", "outlaw", "subtlety", "enhancement", "arms", "fury"]
-    ranged_specs = ["balance", "augmentation", "devastation", "beast mastery", "marksmanship", "arcane", "fire", "frost", "shadow", "elemental", "affliction", "demonology", "destruction"]
-
-    # Get top players for each category
-    top3_tank = sorted(
-        [member for member in guild_members if member.get('rio_tank', 0) >= 1000],
-        key=lambda x: max(x.get('rio_tank', 0), 0),
-        reverse=True
-    )[:top]
-    top3_healer = sorted(
-        [member for member in guild_members if member.get('rio_healer', 0) >= 1000],
-        key=lambda x: max(x.get('rio_healer', 0), 0),
-        reverse=True
-    )[:top]
-    top3_mdd = sorted([member for member in guild_members if member.get('active_spec_name') and member['active_spec_name'].lower() in melee_specs and member['class'] != 'Mage'], key=lambda x: max(x.get('rio_dps', 0), 0), reverse=True)[:top]
-    top3_rdd = sorted([member for member in guild_members if member.get('active_spec_name') and member['active_spec_name'].lower() in ranged_specs and member['class'] != 'Death Knight'], key=lambda x: max(x.get('rio_dps', 0), 0), reverse=True)[:top]
-
     # Send initial response to acknowledge the command
-    await interaction.response.send_message(f"Top {top} Players for the Tournament:")
-
-    # Create and send messages for each category separately
-    categories = [
-        ("Tanks", top3_tank, "rio_tank"),
-        ("Healers", top3_healer, "rio_healer"),
-        ("Melee DPS", top3_mdd, "rio_dps"),
-        ("Ranged DPS", top3_rdd, "rio_dps"),
-    ]
-
-    for category_name, top_players, rating_key in categories:
-        result_message = f"\n{category_name}:\n"
-        for i, member in enumerate(top_players):
-            if format == "new":
-                result_message += f"{i + 1}. {member['name']} ({member['guild']}) - {member['active_spec_name']} {member['class']} - {member.get(rating_key, 'N/A')}\n"
-            else:
-                result_message += f"{i + 1}. {member['name']} - {member['active_spec_name']} {member['class']} - {member.get(rating_key, 'N/A')}\n"
+    await interaction.response.send_message(header_message)
 
+    # Send messages for each category separately
+    for result_message in result_messages:
         # Split the result message into chunks and send each part
         max_message_length = 2000
         for i in range(0, len(result_message), max_message_length):
@@ -385,22 +579,26 @@ async def tournament(interaction, guild: str = "Нехай Щастить", top:
         
 # Command "About us"
 @tree.command(name="about_us", description="About us")
+@metrics.timed('command_seconds', command='about_us')
 async def about_us(interaction):    
     await interaction.response.send_message("https://youtu.be/xvpVTd1gt5Q")
     
 # Command "Rules"
 @tree.command(name="rules", description="Rules")
+@metrics.timed('command_seconds', command='rules')
 async def rules(interaction):
     await interaction.response.send_message("https://cdn.discordapp.com/attachments/786720808788688918/1202356554523742289/image.png?ex=65e8d84d&is=65d6634d&hm=dee787e24cb77005a58568556547af37a24fe98bfcb11c1f6ecabc1bf72842ff&")
     
 # Command "Help"
 @tree.command(name="help", description="Get information about available commands")
+@metrics.timed('command_seconds', command='help')
 async def help_command(interaction):
     try:
         help_message = (
             "**Available Commands:**\n"
             "\n/guilds - Get guild raid ranks in the current addon.\n"
             "       -season: Season number (1, 2, or 3, default is 3).\n"
+            "       -refresh: Fetch fresh data instead of the cached one (administrators only).\n"
             
             "\n/rank - Get player ranks in the current M+ season.\n"            
             "       -top: Number of top players to display (1-50, default is 10).\n"
@@ -413,12 +611,18 @@ async def help_command(interaction):
             "       -guild: Top players of which guild will be searched.\n"
             "       -top: Top X players.\n"
             
+            "\n/guildstats - Compare guilds by the M+ scores of their members.\n"
+            "       -guild: all to compare every guild, or one guild for its details.\n"
+            "       -sort: Order of the comparison (median, mean, p90, best, members, strong).\n"
+            
             "\n/about_us - Learn more about us.\n"
             
             "\n/rules - Rules.\n"
             
             "\n/help - Get information about available commands.\n"
             
+            "\n/stats - Bot metrics (administrators only).\n"
+            
             "\nSourse code - https://github.com/CemXokenc/uawowguilds.\n"
         )
         
@@ -428,16 +632,92 @@ async def help_command(interaction):
         print(f"An error occurred while processing the help command: {e}")
         await interaction.response.send_message("An error occurred while processing the command. Please try again later.")
 
+# Command to show the bot metrics to administrators
+@tree.command(name="stats", description="Bot metrics (administrators only)")
+@metrics.timed('command_seconds', command='stats')
+async def stats(interaction):
+    if not getattr(getattr(interaction.user, 'guild_permissions', None), 'administrator', False):
+        await interaction.response.send_message("Only administrators can see the bot metrics.", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True)
+
+    lines = [
+        f"/rank cache: {rank_cache.hits} hits, {rank_cache.misses} misses, {len(rank_cache.replies)} replies",
+        f"Coalesced calls: {single_flight.coalesced}",
+        f"JSON backend: {fastjson.BACKEND}",
+    ]
+    if http_client is not None:
+        lines.append(http_client.summary())
+    if crawl_cache is not None:
+        lines.append(crawl_cache.summary())
+    lines.append(metrics.summary())
+
+    # Code blocks keep the metric names from being read as markdown
+    message_chunks = [f"```\n{chunk}```" for chunk in split_message("\n".join(lines), 1990)]
+    await send_chunks(interaction, message_chunks, ephemeral=True)
+
 # Event handler for bot readiness
 @client.event
 async def on_ready():
+    global http_client, guild_refresh_task, crawl_limiter, crawl_cache, metrics_task, loop_lag_task
+
+    # Create the shared HTTP client once, on_ready also fires after reconnects
+    if http_client is None:
+        http_client = raiderio.HttpClient()
+
+    # Start keeping the /guilds cache warm
+    if guild_refresh_task is None:
+        guild_refresh_task = asyncio.create_task(refresh_guild_cache_loop())
+
+    # Start rebuilding the snapshots in the background with a share of the request budget
+    if not crawl_tasks:
+        crawl_limiter = raiderio.TokenBucket(
+            int(parser.REQUESTS_PER_WINDOW * CRAWL_BUDGET_SHARE), parser.WINDOW_SECONDS, parser.BURST_SIZE
+        )
+        crawl_cache = raiderio.ResponseCache()
+        crawl_tasks.append(asyncio.create_task(crawl_loop('members', crawl_members, MEMBERS_PATH, MEMBERS_CRAWL_INTERVAL)))
+        crawl_tasks.append(asyncio.create_task(crawl_loop('tournament', crawl_tournament, TOURNAMENT_PATH, TOURNAMENT_CRAWL_INTERVAL)))
+
+    # Start dumping the metrics
+    if metrics_task is None:
+        metrics_task = asyncio.create_task(write_metrics_loop())
+
+    # Start watching for callbacks that block the event loop
+    if loop_lag_task is None:
+        loop_lag_task = asyncio.create_task(monitor_loop_lag())
+
     # Synchronize the command tree    
     await tree.sync()
     print("Ready!")
     
+# Function to get the IDs of the required and skipped roles of a guild, the roles are looked up once per guild
+def get_guild_roles(guild):
+    roles = guild_roles.get(guild.id)
+    if roles is None:
+        required_role = discord.utils.get(guild.roles, name=REQUIRED_ROLE)
+        skiped_role = discord.utils.get(guild.roles, name=SKIPPED_ROLE)
+        roles = (required_role and required_role.id, skiped_role and skiped_role.id)
+        guild_roles[guild.id] = roles
+    return roles
+
+# Event handlers that drop the cached role IDs of a guild when its roles change
+@client.event
+async def on_guild_role_create(role):
+    guild_roles.pop(role.guild.id, None)
+
+@client.event
+async def on_guild_role_update(before, after):
+    guild_roles.pop(after.guild.id, None)
+
+@client.event
+async def on_guild_role_delete(role):
+    guild_roles.pop(role.guild.id, None)
+
 # Event handler for new messages
 @client.event
 async def on_message(message):
+    metrics.increment('messages_total', stage='received')
+
     # Check myself
     if message.author == client.user:
         return
@@ -445,28 +725,38 @@ async def on_message(message):
     if message.guild is None:
         return
 
-    # Config    
-    required_role = discord.utils.get(message.guild.roles, name="Guest")
-    skiped_role = discord.utils.get(message.guild.roles, name="guild member")
-    author = message.author.nick if isinstance(message.author, discord.Member) and message.author.nick else message.author.display_name    
-    name_pattern = r"[|/(\[]"
-    
-    # Check if the message contains trigger text    
-    if "видайте мені роль члена гільдії" in message.content.lower() and "флудилка" in message.channel.name:
-        # If the author has the skiped_role, skip the checks
-        if skiped_role in message.author.roles:
-            await message.reply("You already have a role")            
-        else:    
-            # Check if the message author has a specific role and the message is sent in a specific channel
-            if required_role not in message.author.roles or not re.search(name_pattern, author):
-                # Check if the bot has permission to add reactions
-                if message.channel.permissions_for(message.guild.me).add_reactions:
-                    await message.add_reaction("⛔")
-                else:
-                    print("Bot does not have permission to add reactions in this channel.")
-                    
-                # Replying with a message
-                await message.reply("https://cdn.discordapp.com/attachments/786720808788688918/1202356554523742289/image.png?ex=65e8d84d&is=65d6634d&hm=dee787e24cb77005a58568556547af37a24fe98bfcb11c1f6ecabc1bf72842ff&")
+    # The channel is checked first, it rules out almost every message without reading the content
+    if TRIGGER_CHANNEL not in message.channel.name:
+        return
+    metrics.increment('messages_total', stage='channel')
+
+    # Check if the message contains trigger text
+    if not TRIGGER_PATTERN.search(message.content):
+        return
+    metrics.increment('messages_total', stage='trigger')
+
+    # Config
+    required_role_id, skiped_role_id = get_guild_roles(message.guild)
+    author_role_ids = {role.id for role in message.author.roles}
+    author = message.author.nick if isinstance(message.author, discord.Member) and message.author.nick else message.author.display_name
+
+    # If the author has the skiped_role, skip the checks
+    if skiped_role_id in author_role_ids:
+        metrics.increment('messages_total', stage='already_member')
+        await message.reply("You already have a role")
+    # Check if the message author has a specific role and a guild tag in the name
+    elif required_role_id not in author_role_ids or not NAME_PATTERN.search(author):
+        metrics.increment('messages_total', stage='rejected')
+        # Check if the bot has permission to add reactions
+        if message.channel.permissions_for(message.guild.me).add_reactions:
+            await message.add_reaction("⛔")
+        else:
+            print("Bot does not have permission to add reactions in this channel.")
+
+        # Replying with a message
+        await message.reply("https://cdn.discordapp.com/attachments/786720808788688918/1202356554523742289/image.png?ex=65e8d84d&is=65d6634d&hm=dee787e24cb77005a58568556547af37a24fe98bfcb11c1f6ecabc1bf72842ff&")
             
 # Run the bot
-client.run(token)
+if __name__ == "__main__":
+    from config import token
+    client.run(token)
@@ -0,0 +1,38 @@
+import json
+
+import aiohttp
+
+try:
+    import orjson
+except ImportError:  # Optional, the standard json module is used instead
+    orjson = None
+
+# JSON decoding shared by the bot and the parsers, through orjson when it is installed
+# Both decoders hold the GIL for the whole document, so a worker thread would not keep the event loop running meanwhile:
+# large documents are best kept off the loop altogether, like the snapshots MemberStore converts in a worker process
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+# Function to decode a JSON document from bytes or str
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# Function to decode a JSON file
+def load(path):
+    with open(path, 'rb') as file:
+        return loads(file.read())
+
+# Asynchronous function to read the JSON body of an aiohttp response, the replacement for response.json()
+# Like response.json(), a body that is not declared as JSON raises aiohttp.ContentTypeError and an empty body gives None
+async def read_json(response):
+    body = await response.read()
+    if 'json' not in response.content_type:
+        raise aiohttp.ContentTypeError(
+            response.request_info, response.history, status=response.status,
+            message=f"Attempt to decode JSON with unexpected mimetype: {response.content_type}", headers=response.headers
+        )
+    if not body.strip():
+        return None
+    return loads(body)
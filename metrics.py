@@ -0,0 +1,147 @@
+import bisect
+import contextlib
+import functools
+import os
+import time
+
+# Lightweight in-process metrics: counters and fixed-bucket histograms, shown by /stats,
+# dumped in the Prometheus text format and summarized at the end of each crawl
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # Seconds
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)  # Bytes
+
+counters = {}  # (name, labels) -> value
+histograms = {}  # (name, labels) -> Histogram
+
+# Histogram with fixed upper bounds, the last bucket counts everything above them
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Upper bound of the bucket holding the given fraction of the observations, inf if it is above the last bound
+    def percentile(self, fraction):
+        if not self.count:
+            return 0.0
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= fraction * self.count:
+                return bound
+        return float('inf')
+
+# Function to turn keyword labels into a hashable, ordered key
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+# Function to add to a counter
+def increment(name, value=1, **labels):
+    key = (name, label_key(labels))
+    counters[key] = counters.get(key, 0) + value
+
+# Function to record a value in a histogram
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    key = (name, label_key(labels))
+    histogram = histograms.get(key)
+    if histogram is None:
+        histogram = histograms[key] = Histogram(buckets)
+    histogram.observe(value)
+
+# Context manager that records the seconds its block took, also when the block raises
+@contextlib.contextmanager
+def timer(name, **labels):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start_time, **labels)
+
+# Decorator that records the seconds every call of an async function takes
+def timed(name, **labels):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Function to drop every counter and histogram, such as in a worker process that starts another shard
+def reset():
+    counters.clear()
+    histograms.clear()
+
+# Function to add the counters and histograms of another process, such as a crawl shard
+def merge(other_counters, other_histograms):
+    for key, value in other_counters.items():
+        counters[key] = counters.get(key, 0) + value
+    for key, other in other_histograms.items():
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(other.buckets)
+        histogram.counts = [count + other_count for count, other_count in zip(histogram.counts, other.counts)]
+        histogram.count += other.count
+        histogram.sum += other.sum
+
+# Function to format labels the way Prometheus expects them
+def format_labels(labels, extra=()):
+    labels = labels + tuple(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+# Function to format a bucket bound exactly, 4194304 instead of the rounded 4.1943e+06
+def format_bound(bound):
+    if bound == float('inf'):
+        return "+Inf"
+    if isinstance(bound, int):
+        return str(bound)
+    return repr(float(bound))
+
+# Function to get every metric in the Prometheus text format
+def prometheus_text():
+    lines = []
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE {name} counter")
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (metric, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', format_bound(bound))])} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum:.6f}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+# Function to write the Prometheus text dump, replacing the file at once
+def write_prometheus(path):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        file.write(prometheus_text())
+    os.replace(temp_path, path)
+
+# Function to get a short human-readable summary: counters, then count, mean and p50/p99 bucket bounds per histogram
+def summary():
+    lines = []
+    for (name, labels), value in sorted(counters.items()):
+        lines.append(f"{name}{format_labels(labels)}: {value}")
+    for (name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+        mean = histogram.sum / histogram.count if histogram.count else 0.0
+        lines.append(
+            f"{name}{format_labels(labels)}: count {histogram.count}, mean {mean:.4g}, "
+            f"p50 <= {format_bound(histogram.percentile(0.5))}, p99 <= {format_bound(histogram.percentile(0.99))}"
+        )
+    return "\n".join(lines)
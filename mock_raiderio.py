@@ -0,0 +1,140 @@
+import argparse
+import asyncio
+import hashlib
+import math
+import random
+import time
+from aiohttp import web
+
+# Local stand-in for the raider.io endpoints used by the crawlers and the bot, serving synthetic data for benchmarks
+# Usage: python mock_raiderio.py --port 8080 --latency 0.05 --error-rate 0.01 --rate-limit 300
+
+CLASS_SPECS = {
+    'Death Knight': ['Blood', 'Frost', 'Unholy'],
+    'Demon Hunter': ['Havoc', 'Vengeance'],
+    'Druid': ['Balance', 'Feral', 'Guardian', 'Restoration'],
+    'Evoker': ['Devastation', 'Preservation', 'Augmentation'],
+    'Hunter': ['Beast Mastery', 'Marksmanship', 'Survival'],
+    'Mage': ['Arcane', 'Fire', 'Frost'],
+    'Monk': ['Brewmaster', 'Mistweaver', 'Windwalker'],
+    'Paladin': ['Holy', 'Protection', 'Retribution'],
+    'Priest': ['Discipline', 'Holy', 'Shadow'],
+    'Rogue': ['Assassination', 'Outlaw', 'Subtlety'],
+    'Shaman': ['Elemental', 'Enhancement', 'Restoration'],
+    'Warlock': ['Affliction', 'Demonology', 'Destruction'],
+    'Warrior': ['Arms', 'Fury', 'Protection'],
+}
+RAIDS = ("nerubar-palace", "liberation-of-undermine", "manaforge-omega")
+
+# Function to get a random generator seeded by the given values, so every run serves the same data
+def seeded_random(*values):
+    return random.Random(hashlib.md5("|".join(str(value).lower() for value in values).encode()).digest())
+
+# Function to build the synthetic profile of a character
+def synthetic_character(realm, name):
+    rng = seeded_random(realm, name)
+    class_ = rng.choice(sorted(CLASS_SPECS))
+    specs = CLASS_SPECS[class_]
+    spec_scores = [round(rng.uniform(0, 3500), 1) if i < len(specs) else 0 for i in range(4)]
+    return {
+        'name': name,
+        'realm': realm,
+        'region': 'eu',
+        'class': class_,
+        'active_spec_name': rng.choice(specs),
+        'mythic_plus_scores_by_season': [{
+            'season': 'season-tww-3',
+            'scores': {
+                'all': max(spec_scores),
+                'dps': round(rng.uniform(0, 3500), 1),
+                'healer': round(rng.uniform(0, 3500), 1) if rng.random() < 0.3 else 0,
+                'tank': round(rng.uniform(0, 3500), 1) if rng.random() < 0.3 else 0,
+                **{f'spec_{i}': score for i, score in enumerate(spec_scores)},
+            },
+        }],
+    }
+
+class MockRaiderIO:
+    def __init__(self, members_per_guild=50, latency=0.05, error_rate=0.0, rate_limit=0, seed=0):
+        self.members_per_guild = members_per_guild
+        self.latency = latency  # Mean seconds added to every response
+        self.error_rate = error_rate  # Share of requests answered with a 503
+        self.rate_limit = rate_limit  # Requests per second before answering with a 429, 0 disables it
+        self.random = random.Random(seed)
+        self.tokens = rate_limit
+        self.updated = time.monotonic()
+
+        self.app = web.Application(middlewares=[self.middleware])
+        self.app.router.add_get('/api/v1/guilds/profile', self.guild_profile)
+        self.app.router.add_get('/api/v1/characters/profile', self.character_profile)
+        self.app.router.add_get('/api/guilds/boss-kills', self.boss_kills)
+
+    # Applies the rate limit, the simulated latency and the injected errors to every request
+    @web.middleware
+    async def middleware(self, request, handler):
+        if self.rate_limit:
+            now = time.monotonic()
+            self.tokens = min(self.rate_limit, self.tokens + (now - self.updated) * self.rate_limit)
+            self.updated = now
+            if self.tokens < 1:
+                wait = (1 - self.tokens) / self.rate_limit
+                return web.json_response(
+                    {'statusCode': 429, 'error': 'Too Many Requests'},
+                    status=429,
+                    headers={'Retry-After': str(math.ceil(wait)), 'X-RateLimit-Remaining': '0'}
+                )
+            self.tokens -= 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency * self.random.uniform(0.5, 1.5))
+        if self.random.random() < self.error_rate:
+            return web.json_response({'statusCode': 503, 'error': 'Service Unavailable'}, status=503)
+        return await handler(request)
+
+    async def guild_profile(self, request):
+        name = request.query.get('name', '')
+        realm = request.query.get('realm', '')
+        fields = request.query.get('fields', '').split(',')
+        rng = seeded_random(realm, name)
+        data = {'name': name, 'realm': realm, 'region': 'eu'}
+
+        if 'members' in fields:
+            prefix = name.replace(' ', '')
+            data['members'] = []
+            for i in range(self.members_per_guild):
+                character = synthetic_character(realm, f"{prefix}m{i}")
+                data['members'].append({
+                    'rank': rng.randint(0, 9),
+                    'character': {key: character[key] for key in ('name', 'realm', 'class', 'active_spec_name')},
+                })
+        if 'raid_progression' in fields:
+            data['raid_progression'] = {
+                raid: {'summary': f"{rng.randint(0, 8)}/8 {rng.choice('NHM')}"} for raid in RAIDS
+            }
+        if 'raid_rankings' in fields:
+            data['raid_rankings'] = {raid: {'mythic': {'world': rng.randint(1, 5000)}} for raid in RAIDS}
+        return web.json_response(data)
+
+    async def character_profile(self, request):
+        return web.json_response(synthetic_character(request.query.get('realm', ''), request.query.get('name', '')))
+
+    async def boss_kills(self, request):
+        rng = seeded_random(request.query.get('realm', ''), request.query.get('guild', ''), request.query.get('boss', ''))
+        return web.json_response({
+            'killDetails': {'attempt': {'bestPercent': round(rng.uniform(0.1, 100), 2), 'pullCount': rng.randint(1, 400)}}
+        })
+
+# Function to serve the mock until the process is stopped
+def run(port=8080, **options):
+    web.run_app(MockRaiderIO(**options).app, port=port, print=None)
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description="Mock raider.io server for offline benchmarks")
+    arguments.add_argument('--port', type=int, default=8080)
+    arguments.add_argument('--members-per-guild', type=int, default=50)
+    arguments.add_argument('--latency', type=float, default=0.05, help="Mean seconds added to every response")
+    arguments.add_argument('--error-rate', type=float, default=0.0, help="Share of requests answered with a 503")
+    arguments.add_argument('--rate-limit', type=float, default=0, help="Requests per second before a 429, 0 disables it")
+    args = arguments.parse_args()
+    run(args.port, members_per_guild=args.members_per_guild, latency=args.latency,
+        error_rate=args.error_rate, rate_limit=args.rate_limit)
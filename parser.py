@@ -1,9 +1,35 @@
 import aiohttp
+import argparse
 import asyncio
 import json
+import os
 import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
 
-error_urls = []  # List to store URLs that returned errors during requests
+import fastjson
+import metrics
+import raiderio
+import snapshot
+
+# Crawl settings: raider.io allows REQUESTS_PER_WINDOW requests every WINDOW_SECONDS
+WORKER_COUNT = 8  # Number of concurrent character workers
+GUILD_WORKER_COUNT = 2  # Number of concurrent guild roster fetches
+QUEUE_SIZE = 500  # Character keys buffered between roster fetches and character workers
+REQUESTS_PER_WINDOW = 190
+WINDOW_SECONDS = 2 * 60
+BURST_SIZE = 10  # Requests that may be sent back to back after an idle period
+MAX_SHARDS = REQUESTS_PER_WINDOW // 2  # Each shard needs a burst of 1 and at least one more request per window
+
+OUTPUT_PATH = r'C:\Users\Administrator\Desktop\members.json'
+CHECKPOINT_PATH = r'C:\Users\Administrator\Desktop\members.ndjson'  # Finished records of an interrupted crawl
+CHECKPOINT_MAX_AGE = 24 * 60 * 60  # Older checkpoints are discarded instead of resumed
+METRICS_PATH = r'C:\Users\Administrator\Desktop\parser_metrics.prom'  # Metrics of the last crawl, Prometheus text format
+NOT_FOUND_PATH = "400.txt"  # Characters raider.io does not know, one per line
+
+DEFAULT_REGION = "eu"  # Region of guild list entries and additional characters that do not name one
+REGIONS = ("us", "eu", "kr", "tw", "cn")  # Regions raider.io serves, a line of the additional characters file may end with one
 
 # Function to read guild data from the file
 def read_guild_data(file_path=r'C:\Users\Administrator\Desktop\uaguildlist.txt'):
@@ -14,41 +40,54 @@ def read_guild_data(file_path=r'C:\Users\Administrator\Desktop\uaguildlist.txt')
         print(f"An error occurred while reading guild data: {e}")
         return []
 
-# Function to read additional characters from a file
+# Function to read additional characters from a file, one "name realm [region]" per line
 def read_additional_characters(file_path=r'C:\Users\Administrator\Desktop\addCharacters.txt'):
     try:
         with open(file_path, 'r', encoding='utf-8') as file:
             characters = []
             for line in file:
                 parts = line.strip().split()
+                region = DEFAULT_REGION
+                if len(parts) >= 3 and parts[-1].lower() in REGIONS:
+                    region = parts.pop().lower()
                 if len(parts) >= 2:
                     name = parts[0]
                     realm = " ".join(parts[1:])  # Якщо сервер складається з кількох слів
-                    characters.append((realm, name))
+                    characters.append((region, realm, name))
             return characters
     except Exception as e:
         print(f"An error occurred while reading additional characters: {e}")
         return []
 
-# Asynchronous function to fetch data from a given URL
-async def fetch_data(session, url):
-    try:
-        async with session.get(url) as response:
-            return await response.json()
-    except Exception as e:
-        print(f"Error fetching data from {url}: {e}")
-        error_urls.append(url)
-        return None
+# Function to get the (region, realm, name) of a guild list entry such as "region=eu&realm=Tarren Mill&name=Нехай Щастить"
+def guild_key(entry):
+    fields = dict(parse_qsl(entry))
+    return (fields.get('region', DEFAULT_REGION), fields.get('realm', ''), fields.get('name', ''))
+
+# Function to get the canonical key of a character record, records written before regions were tracked are in the default region
+def record_key(record):
+    return raiderio.character_key(record['realm'], record['name'], record.get('region', DEFAULT_REGION))
+
+# Function to merge another record of the same character into the kept one, the kept record only gains the fields it lacks
+def merge_record(kept, record):
+    for field, value in record.items():
+        if kept.get(field) is None and value is not None:
+            kept[field] = value
+    return kept
 
 # Asynchronous function to process a player and fetch their RIO data
-async def process_player(session, realm, name, data_dict):
-    url = f"http://raider.io/api/v1/characters/profile?region=eu&realm={realm}&name={name}&fields=mythic_plus_scores_by_season:current,class,active_spec_name"
-    player_data = await fetch_data(session, url)
+async def process_player(session, region, realm, name, data_dict, limiter=None, cache=None, writer=None, not_found_path=NOT_FOUND_PATH, failed_urls=None):
+    player_key = raiderio.character_key(realm, name, region)
+    url = raiderio.character_profile_url(realm, name, region)
+    player_data = await raiderio.fetch_data(session, url, limiter, cache, failed_urls=failed_urls)
 
     if player_data is not None:
         if 'statusCode' in player_data and player_data['statusCode'] == 400:
-            with open("400.txt", "a", encoding="utf-8") as error_file:
+            with open(not_found_path, "a", encoding="utf-8") as error_file:
                 error_file.write(f"Character not found: {name} from realm {realm}\n")
+            # Keep the roster data as it is and do not ask for this character again when resuming
+            if writer is not None and player_key in data_dict:
+                writer.write(data_dict.pop(player_key))
             return
 
         # Отримуємо основні дані персонажа
@@ -67,9 +106,10 @@ async def process_player(session, realm, name, data_dict):
         spec_3 = scores.get('spec_3', 0)
 
         # Оновлюємо дані у словнику
-        data_dict[(realm, name)] = {
+        data_dict[player_key] = {
+            'region': region,
             'realm': realm,
-            'guild': data_dict.get((realm, name), {}).get('guild', None),
+            'guild': data_dict.get(player_key, {}).get('guild', None),
             'name': name,
             'class': class_,
             'active_spec_name': active_spec_name,
@@ -83,10 +123,16 @@ async def process_player(session, realm, name, data_dict):
             'spec_3': spec_3,
         }
 
-# Asynchronous function to process a guild and fetch its members
-async def process_guild(session, url, data_dict):
-    guild_data = await fetch_data(session, url)
-    if 'members' in guild_data:
+        # Stream the finished record to the checkpoint instead of keeping it in memory
+        if writer is not None:
+            writer.write(data_dict.pop(player_key))
+
+# Asynchronous function to process a guild and queue its members for the character workers
+async def process_guild(session, url, data_dict, queue=None, limiter=None, cache=None, failed_urls=None):
+    # Members are in the region of their guild
+    region = dict(parse_qsl(urlsplit(url).query)).get('region', DEFAULT_REGION)
+    guild_data = await raiderio.fetch_data(session, url, limiter, cache, failed_urls=failed_urls)
+    if guild_data and 'members' in guild_data:
         for member in guild_data.get('members', []):
             realm = member.get('character', {}).get('realm')
             guild = guild_data.get('name')
@@ -95,55 +141,342 @@ async def process_guild(session, url, data_dict):
             active_spec_name = member.get('character', {}).get('active_spec_name')
 
             if name and class_:
-                player_key = (realm, name)
-                data_dict[player_key] = {
-                    'realm': realm, 'guild': guild, 'name': name,
+                player_key = raiderio.character_key(realm, name, region)
+                # A worker may already have stored the full record, so only the guild is updated
+                record = data_dict.setdefault(player_key, {
+                    'region': region, 'realm': realm, 'guild': guild, 'name': name,
                     'class': class_, 'active_spec_name': active_spec_name
-                }
+                })
+                record['guild'] = guild
+                if queue is not None:
+                    await queue.put((region, realm, name))
 
-# Main function to coordinate fetching and processing data
-async def main():
-    with open("400.txt", "w", encoding="utf-8") as error_file:
-        error_file.write("")
+# Queue of (region, realm, name) characters that drops characters which were already scheduled under any spelling
+# Characters in the checkpoint of an interrupted crawl are skipped the first time they come, later ones are duplicates
+class PlayerQueue:
+    def __init__(self, maxsize, completed=()):
+        self.queue = asyncio.Queue(maxsize)
+        self.seen = set()  # Canonical keys of the scheduled and skipped characters
+        self.completed = set(completed)  # Canonical keys of the characters the checkpoint already has
+        self.duplicates = 0  # Number of characters dropped at enqueue time
+        self.resumed = 0  # Number of characters skipped because the checkpoint has them
+
+    async def put(self, character):
+        region, realm, name = character
+        player_key = raiderio.character_key(realm, name, region)
+        if player_key in self.seen:
+            self.duplicates += 1
+            return
+        self.seen.add(player_key)
+        if player_key in self.completed:
+            self.resumed += 1
+            return
+        await self.queue.put(character)
+
+    async def get(self):
+        return await self.queue.get()
+
+    # Tell every worker that no more keys will arrive
+    async def close(self, worker_count):
+        for _ in range(worker_count):
+            await self.queue.put(None)
+
+# Function to read the records of an NDJSON file, dropping a partly written last line
+def read_records(path):
+    if not os.path.exists(path):
+        return
+    valid_size = 0
+    with open(path, 'rb') as file:
+        for line in file:
+            if not line.endswith(b"\n"):
+                break
+            valid_size += len(line)
+            try:
+                yield fastjson.loads(line)
+            except ValueError:
+                continue
+    if valid_size != os.path.getsize(path):
+        os.truncate(path, valid_size)
+
+# Appends each finished character record to an NDJSON checkpoint, so a restarted crawl can skip it
+class RecordWriter:
+    def __init__(self, path, max_age=CHECKPOINT_MAX_AGE):
+        self.path = path
+        self.completed = set()  # Keys of the records in the checkpoint
+        if os.path.exists(path) and time.time() - os.path.getmtime(path) > max_age:
+            os.remove(path)
+        for record in read_records(path):
+            self.completed.add(record_key(record))
+        self.resumed = len(self.completed)
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.completed.add(record_key(record))
+
+    def close(self):
+        self.file.close()
+
+# Function to get the final records: the checkpoint plus the remaining roster records, each character once
+def final_records(writer, data_dict):
+    written = set()
+    for record in read_records(writer.path):
+        player_key = record_key(record)
+        if player_key not in written:
+            written.add(player_key)
+            yield record
+    # Characters whose profile could not be fetched keep their roster data
+    for player_key, record in data_dict.items():
+        if player_key not in written and player_key not in writer.completed:
+            written.add(player_key)
+            yield record
+
+# Function to compact the checkpoint and the remaining roster records into the final JSON file
+def write_members_json(output_path, writer, data_dict):
+    return write_records_json(output_path, final_records(writer, data_dict))
+
+# Function to write records to a JSON file, returns the number of records
+def write_records_json(output_path, records):
+    temp_path = output_path + '.tmp'
+    count = 0
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        file.write('[')
+        for record in records:
+            file.write(',\n' if count else '\n')
+            file.write(json.dumps(record, ensure_ascii=False, indent=2))
+            count += 1
+        file.write('\n]\n')
+    # Readers of the output file never see a partly written file
+    os.replace(temp_path, output_path)
+    return count
+
+# Worker that fetches guild rosters from a shared iterator of URLs
+async def guild_worker(session, urls, data_dict, queue, limiter, cache, failed_urls):
+    for url in urls:
+        await process_guild(session, url, data_dict, queue, limiter, cache, failed_urls)
+
+# Asynchronous function to queue characters from the additional characters file
+async def process_additional_characters(additional_characters, data_dict, queue):
+    for region, realm, name in additional_characters:
+        record = {
+            'region': region, 'realm': realm, 'guild': None, 'name': name,
+            'class': None, 'active_spec_name': None
+        }
+        # A character that is also on a roster keeps the roster record and its guild
+        merge_record(data_dict.setdefault(raiderio.character_key(realm, name, region), record), record)
+        await queue.put((region, realm, name))
+
+# Worker that fetches RIO data for players taken from the shared queue
+async def player_worker(session, queue, data_dict, limiter, cache, writer, not_found_path, failed_urls):
+    while True:
+        character = await queue.get()
+        if character is None:
+            return
+        region, realm, name = character
+        try:
+            await process_player(session, region, realm, name, data_dict, limiter, cache, writer, not_found_path, failed_urls)
+        except Exception as e:
+            print(f"An error occurred while processing {name} from realm {realm}: {e}")
+
+# Asynchronous function to crawl the guild rosters and characters with the given session and write the members file
+# Returns the number of members written, write_binary=False skips the binary snapshot of a partial crawl
+# URLs that failed after all retries are appended to failed_urls if a list is given
+@metrics.timed('crawl_seconds', crawler='members')
+async def crawl(session, guild_list, additional_characters, limiter=None, cache=None,
+                output_path=OUTPUT_PATH, checkpoint_path=CHECKPOINT_PATH, write_binary=True, not_found_path=NOT_FOUND_PATH, failed_urls=None):
+    # Resume from the checkpoint of an interrupted crawl, if there is one, read off the event loop the bot shares
+    writer = await asyncio.to_thread(RecordWriter, checkpoint_path)
+    if writer.resumed:
+        print(f"Resuming crawl, {writer.resumed} characters already done")
+    else:
+        with open(not_found_path, "w", encoding="utf-8") as error_file:
+            error_file.write("")
 
     data_dict = {}  # Dictionary to store player data
-    prefix = "http://raider.io/api/v1/guilds/profile?region=eu&"
+    failed_urls = [] if failed_urls is None else failed_urls  # Kept per crawl, the bot runs two crawls at once
+    prefix = f"{raiderio.API_BASE}/api/v1/guilds/profile?"
     postfix = "&fields=members"
 
+    # Character workers start right away and drain the queue while rosters are still being fetched
+    queue = PlayerQueue(QUEUE_SIZE, writer.completed)
+    workers = [asyncio.create_task(player_worker(session, queue, data_dict, limiter, cache, writer, not_found_path, failed_urls)) for _ in range(WORKER_COUNT)]
+    try:
+        # Process guilds, pushing their members onto the queue
+        urls = iter([prefix + url + postfix for url in guild_list])
+        await asyncio.gather(*[guild_worker(session, urls, data_dict, queue, limiter, cache, failed_urls) for _ in range(GUILD_WORKER_COUNT)])
+
+        # Additional characters come after the rosters, so a character found in both keeps its guild
+        await process_additional_characters(additional_characters, data_dict, queue)
+        await queue.close(WORKER_COUNT)
+        await asyncio.gather(*workers)
+    finally:
+        # A failed or cancelled crawl leaves no worker behind that keeps appending to the checkpoint of the next one
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        writer.close()
+    # Characters listed more than once, by several sources or under different spellings, were fetched once
+    print(f"Characters: {len(queue.seen)}, duplicates collapsed: {queue.duplicates}")
+    if writer.resumed:
+        print(f"Characters taken from the checkpoint: {queue.resumed}")
+    metrics.increment('characters_collapsed_total', queue.duplicates, crawler='members')
+    print(f"Requests that failed after all retries: {len(failed_urls)}")
+
+    # Save results to JSON, the checkpoint is not needed once the output is complete
+    # The files are written in a thread, so a bot running the crawl keeps answering meanwhile
+    count = await asyncio.to_thread(write_members_json, output_path, writer, data_dict)
+    print(f"Members written: {count}")
+    # The binary copy is written after the JSON file, so the bot only maps it when it is not older
+    # It is only a faster copy, so a failed write does not keep the checkpoint of a complete crawl around
+    if write_binary:
+        try:
+            await asyncio.to_thread(snapshot.publish_binary_snapshot, output_path, final_records(writer, data_dict))
+        except Exception as e:
+            print(f"An error occurred while writing the binary snapshot of '{output_path}': {e}")
+    os.remove(checkpoint_path)
+    return count
+
+# Function to get the path of a shard's own copy of a file, members.json -> members.shard0.json
+def shard_path(path, index):
+    root, extension = os.path.splitext(path)
+    return f"{root}.shard{index}{extension}"
+
+# Function to get the shard of a guild or character from a stable hash of its canonical realm and name
+def shard_of(realm, name, shard_count):
+    _, realm, name = raiderio.character_key(realm, name)
+    return zlib.crc32(f"{realm}|{name}".encode('utf-8')) % shard_count
+
+# Function to crawl one shard in a worker process under its share of the request budget
+# Returns the members written, the requests sent, the requests that failed and the metrics of the shard
+def run_shard(index, shard_count, guild_list, additional_characters, output_path, checkpoint_path):
+    # A worker process may be reused for another shard, start from empty metrics
+    metrics.reset()
+    return asyncio.run(crawl_shard(index, shard_count, guild_list, additional_characters, output_path, checkpoint_path))
+
+async def crawl_shard(index, shard_count, guild_list, additional_characters, output_path, checkpoint_path):
+    if not 1 <= shard_count <= MAX_SHARDS:
+        raise ValueError(f"shard_count must be between 1 and {MAX_SHARDS}")
+    limiter = raiderio.TokenBucket(REQUESTS_PER_WINDOW // shard_count, WINDOW_SECONDS, max(1, BURST_SIZE // shard_count))
+    # The shards share the cache file, so every write is committed at once
+    cache = raiderio.ResponseCache(commit_every=1)
+    failed_urls = []
+    connector = aiohttp.TCPConnector(ssl=False)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        count = await crawl(session, guild_list, additional_characters, limiter, cache,
+                            shard_path(output_path, index), shard_path(checkpoint_path, index), write_binary=False,
+                            not_found_path=shard_path(NOT_FOUND_PATH, index), failed_urls=failed_urls)
+    cache.close()
+    return count, limiter.acquired, len(failed_urls), metrics.counters, metrics.histograms
+
+# Function to merge the partial files of the shards into one members file, each character once, returns the member count
+# A character crawled by two shards, from a roster and from the additional characters, keeps the fetched scores and the guild
+def merge_shards(shard_count, output_path=OUTPUT_PATH):
+    merged = {}
+    duplicates = 0
+    for index in range(shard_count):
+        for record in fastjson.load(shard_path(output_path, index)):
+            player_key = record_key(record)
+            kept = merged.get(player_key)
+            if kept is None:
+                merged[player_key] = record
+                continue
+            duplicates += 1
+            # Fetched scores come first, then the roster record with the guild
+            if ('rio_all' in record, record['guild'] is not None) > ('rio_all' in kept, kept['guild'] is not None):
+                merged[player_key] = merge_record(record, kept)
+            else:
+                merge_record(kept, record)
+    print(f"Shards merged, duplicates collapsed: {duplicates}")
+    metrics.increment('characters_collapsed_total', duplicates, crawler='members')
+
+    count = write_records_json(output_path, merged.values())
+    snapshot.publish_binary_snapshot(output_path, merged.values())
+    for index in range(shard_count):
+        os.remove(shard_path(output_path, index))
+
+    # Characters raider.io does not know, from every shard
+    with open(NOT_FOUND_PATH, "w", encoding="utf-8") as error_file:
+        for index in range(shard_count):
+            path = shard_path(NOT_FOUND_PATH, index)
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as shard_file:
+                    error_file.write(shard_file.read())
+                os.remove(path)
+    return count
+
+# Function to crawl with one worker process per shard and merge the shards, returns the number of requests sent
+# Guilds and additional characters are split by realm and name, a guild's members are crawled by the guild's shard
+def crawl_sharded(guild_list, additional_characters, shard_count, output_path=OUTPUT_PATH, checkpoint_path=CHECKPOINT_PATH):
+    shards = [([], []) for _ in range(shard_count)]
+    for entry in guild_list:
+        _, realm, name = guild_key(entry)
+        shards[shard_of(realm, name, shard_count)][0].append(entry)
+    for region, realm, name in additional_characters:
+        shards[shard_of(realm, name, shard_count)][1].append((region, realm, name))
+
+    with ProcessPoolExecutor(max_workers=shard_count) as executor:
+        futures = [
+            executor.submit(run_shard, index, shard_count, guilds, characters, output_path, checkpoint_path)
+            for index, (guilds, characters) in enumerate(shards)
+        ]
+        results = [future.result() for future in futures]
+
+    request_count = 0
+    for index, (count, acquired, failed, shard_counters, shard_histograms) in enumerate(results):
+        print(f"Shard {index}: {count} members, {acquired} requests, {failed} failed after all retries")
+        request_count += acquired
+        metrics.merge(shard_counters, shard_histograms)
+    print(f"Members written: {merge_shards(shard_count, output_path)}")
+    return request_count
+
+# Function to parse the --shards argument, every shard must get a usable share of the request budget
+def shard_count_argument(value):
+    shard_count = int(value)
+    if not 1 <= shard_count <= MAX_SHARDS:
+        raise argparse.ArgumentTypeError(f"must be between 1 and {MAX_SHARDS}")
+    return shard_count
+
+# Function to keep the guilds and additional characters of the given regions, None keeps every region
+def select_regions(guild_list, additional_characters, regions=None):
+    if regions is None:
+        return guild_list, additional_characters
+    return (
+        [entry for entry in guild_list if guild_key(entry)[0] in regions],
+        [character for character in additional_characters if character[0] in regions],
+    )
+
+# Main function to coordinate fetching and processing data
+async def main(guild_list, additional_characters):
+    limiter = raiderio.TokenBucket(REQUESTS_PER_WINDOW, WINDOW_SECONDS, BURST_SIZE)
+    cache = raiderio.ResponseCache()
     connector = aiohttp.TCPConnector(ssl=False)
     async with aiohttp.ClientSession(connector=connector) as session:
-        # Process guilds
-        url_list = read_guild_data()
-        request_count = 0
-        for url in url_list:
-            await process_guild(session, prefix + url + postfix, data_dict)
-
-        # Read and add additional characters
-        additional_characters = read_additional_characters()
-        for realm, name in additional_characters:
-            data_dict[(realm, name)] = {
-                'realm': realm, 'guild': None, 'name': name,
-                'class': None, 'active_spec_name': None
-            }
-
-        # Fetch RIO data for all players
-        for player_key in data_dict.keys():
-            realm, name = player_key
-            await process_player(session, realm, name, data_dict)
-            request_count += 1
-            if request_count % 190 == 0:                
-                await asyncio.sleep(2 * 60)  # Pause for 2 minutes
-        
-        # Retry failed URLs
-        for url in error_urls:
-            await process_guild(session, prefix + url + postfix, data_dict)
-
-    # Save results to JSON
-    with open(r'C:\Users\Administrator\Desktop\members.json', 'w', encoding='utf-8') as file:
-        json.dump(list(data_dict.values()), file, ensure_ascii=False, indent=2)
-
-# Measure the execution time
-start_time = time.time()
-asyncio.run(main())
-end_time = time.time()
-print(f"Execution time: {end_time - start_time} seconds")
+        await crawl(session, guild_list, additional_characters, limiter, cache)
+
+    print(cache.summary())
+    cache.close()
+
+    return limiter.acquired
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description="Crawl the guild rosters and additional characters into members.json")
+    arguments.add_argument('--shards', type=shard_count_argument, default=1, help="Worker processes, each crawls its share of the guilds under its share of the request budget")
+    arguments.add_argument('--regions', nargs='+', choices=REGIONS, help="Only crawl these regions, every region by default")
+    options = arguments.parse_args()
+
+    guild_list, additional_characters = select_regions(read_guild_data(), read_additional_characters(), options.regions)
+
+    # Measure the execution time
+    start_time = time.time()
+    if options.shards > 1:
+        request_count = crawl_sharded(guild_list, additional_characters, options.shards)
+    else:
+        request_count = asyncio.run(main(guild_list, additional_characters))
+    end_time = time.time()
+    print(f"Execution time: {end_time - start_time} seconds")
+    print(f"Requests: {request_count}, {request_count / (end_time - start_time):.2f} requests/second")
+
+    # Metrics summary of the crawl: request latency, response sizes, decode time, retries
+    print(metrics.summary())
+    metrics.write_prometheus(METRICS_PATH)
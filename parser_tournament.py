@@ -1,46 +1,66 @@
+import argparse
 import asyncio
-import pandas as pd
 import aiohttp
+import csv
+import io
 import json
 import os
 import time
+import urllib.request
 from collections import defaultdict
 
+import fastjson
+import metrics
+import raiderio
+import snapshot
+
 # Disable SSL certificate verification
 import ssl
 ssl._create_default_https_context = ssl._create_unverified_context
 
-error_urls = []
 sem = asyncio.Semaphore(100)  # Limit concurrent requests
 
+SHEET_URL = "https://docs.google.com/spreadsheets/d/1YdZRWVXzOXaIZfb9YXDfqHEaeaVnv_3j4EykUZ4Kf4E/export?format=csv"
+SHEET_TIMEOUT = 60  # Seconds the sheet download may wait to connect or for more data before it fails
+OUTPUT_PATH = r'C:\Users\Administrator\Desktop\tournament.json'
+STATE_PATH = r'C:\Users\Administrator\Desktop\tournament_state.json'  # Sign-ups and results of the previous sync
+SYNC_TTL = 6 * 60 * 60  # Seconds a fetched score is reused before the character is fetched again
+METRICS_PATH = r'C:\Users\Administrator\Desktop\tournament_metrics.prom'  # Metrics of the last crawl, Prometheus text format
+# Same quota as parser.py, raider.io allows REQUESTS_PER_WINDOW requests every WINDOW_SECONDS
+REQUESTS_PER_WINDOW = 190
+WINDOW_SECONDS = 120
+BURST_SIZE = 10
+
 def get_data_array(sheet_url):
     """
-    Fetches data from a Google Sheets URL and converts it to a NumPy array.
+    Reads the sign-up sheet CSV from a URL or a local file and returns its (name, realm, guild) rows.
+    The rows are parsed while the sheet is downloaded, rows without a name or realm are skipped.
+    A download that stalls for SHEET_TIMEOUT seconds raises instead of blocking the crawl forever.
     """
-    df = pd.read_csv(sheet_url, header=None)  # Read the CSV data into a DataFrame
-    df = df.iloc[1:, 1:4]  # Skip the first row and select columns 1, 2, and 3
-    array = df.to_numpy()  # Convert DataFrame to NumPy array
-    return array
+    if sheet_url.startswith(('http://', 'https://')):
+        source = io.TextIOWrapper(urllib.request.urlopen(sheet_url, timeout=SHEET_TIMEOUT), encoding='utf-8-sig', newline='')
+    else:
+        source = open(sheet_url, 'r', encoding='utf-8-sig', newline='')
 
-async def fetch_data(session, url):
-    try:
-        async with session.get(url) as response:
-            return await response.json()
-    except Exception as e:
-        print(f"Error fetching data from {url}: {e}")
-        error_urls.append(url)
-        return None
-
-async def process_player(session, realm, name, data_dict):
+    with source:
+        rows = csv.reader(source)
+        next(rows, None)  # Skip the header row
+        data_array = []
+        for row in rows:
+            name, realm, guild = (row[1:4] + ['', '', ''])[:3]  # Columns 1, 2 and 3
+            if name and realm:
+                data_array.append((name, realm, guild or None))  # No guild is stored as null, like in members.json
+        return data_array
+
+async def process_player(session, realm, name, data_dict, cache=None, limiter=None, failed_urls=None):
     """
     Processes player data and updates the data_dict with Mythic+ scores.
+    Returns True if the scores were stored.
     """
-    url = f"http://raider.io/api/v1/characters/profile?region=eu&realm={realm}&name={name}&fields=mythic_plus_scores_by_season:current"
-    player_data = await fetch_data(session, url)  # Fetch data for the player
+    url = raiderio.character_profile_url(realm, name)
+    player_data = await raiderio.fetch_data(session, url, limiter, cache, failed_urls=failed_urls)  # Fetch data for the player, reusing cached profiles
     
     if player_data is not None:
-        print(f"Received data for {name} on {realm}: {player_data}")
-        
         if 'mythic_plus_scores_by_season' in player_data:
             scores = player_data['mythic_plus_scores_by_season'][0]['scores']
             all_score = scores.get('all', 0)
@@ -52,7 +72,7 @@ async def process_player(session, realm, name, data_dict):
             spec_2 = scores.get('spec_2', 0)
             spec_3 = scores.get('spec_3', 0)
 
-            player_key = (realm, name)
+            player_key = raiderio.character_key(realm, name)
             player = data_dict[player_key]
 
             # Update player data with scores and guild information
@@ -69,19 +89,54 @@ async def process_player(session, realm, name, data_dict):
                 'class': player_data.get('class', 'Unknown'),
                 'guild': player.get('guild', 'Unknown')  # Use guild from data_dict
             })
+            return True
         else:
-            print(f"Data for {name} does not contain mythic_plus_scores_by_season: {player_data}")
+            print(f"Data for {name} on {realm} does not contain mythic_plus_scores_by_season.")
     else:
         print(f"No data received for {name} on {realm}.")
+    return False
 
-async def main():
+def read_sync_state(state_path):
     """
-    Main function to fetch and process player data from Google Sheets and Raider.io API.
+    Reads the sign-ups and results of the previous sync, keyed by the canonical character key.
+    """
+    try:
+        entries = fastjson.load(state_path)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"Could not read the sync state '{state_path}': {e}, fetching every sign-up")
+        return {}
+    return {raiderio.character_key(entry['row'][1], entry['row'][0]): entry for entry in entries}
+
+def write_sync_state(state_path, entries):
+    """
+    Writes the sign-ups and results of this sync for the next one, replacing the file at once.
+    """
+    temp_path = state_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(entries, file, ensure_ascii=False)
+    os.replace(temp_path, state_path)
+
+def write_tournament_json(output_file_path, records):
+    """
+    Writes the records to the tournament JSON file and its binary copy, replacing each file at once.
+    """
+    temp_path = output_file_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(records, file, ensure_ascii=False, indent=2)  # Write data_dict to JSON file
+    os.replace(temp_path, output_file_path)  # Readers never see a partly written file
+    snapshot.publish_binary_snapshot(output_file_path, records)  # Binary copy for the bot
+
+@metrics.timed('crawl_seconds', crawler='tournament')
+async def crawl(session, data_array, cache=None, output_file_path=OUTPUT_PATH, limiter=None, state_path=None, failed_urls=None):
+    """
+    Fetches Raider.io data for every sign-up row with the given session and writes the tournament JSON file.
+    Up to `sem` players are fetched at once, paced by the limiter if one is given.
+    With a state file only added or changed rows and results older than SYNC_TTL are fetched,
+    the other rows reuse the previous results and removed rows are dropped.
+    URLs that failed after all retries are appended to failed_urls if a list is given.
     """
-    sheet_url = "https://docs.google.com/spreadsheets/d/1YdZRWVXzOXaIZfb9YXDfqHEaeaVnv_3j4EykUZ4Kf4E/export?format=csv"
-    data_array = get_data_array(sheet_url)  # Get data array from Google Sheets
-    print(f"Data array: {data_array}")
-    
     data_dict = defaultdict(lambda: {
         'name': None,
         'realm': None,
@@ -98,40 +153,104 @@ async def main():
         'guild': 'Unknown'
     })
     
+    failed_urls = [] if failed_urls is None else failed_urls  # Kept per crawl, the bot runs two crawls at once
+
     # Fill data_dict with initial data
+    # Sign-ups of the same character, under any spelling of the realm or name, are collapsed into one row:
+    # the last one wins, but keeps the guild of an earlier one if it has none
+    rows = {}  # Canonical character key -> sign-up row
+    duplicates = 0
     for character_name, realm, guild in data_array:
-        data_dict[(realm, character_name)]['name'] = character_name
-        data_dict[(realm, character_name)]['realm'] = realm
-        data_dict[(realm, character_name)]['guild'] = guild
-    
-    connector = aiohttp.TCPConnector(ssl=False)  # Disable SSL certificate verification
-    async with aiohttp.ClientSession(connector=connector) as session:
-        request_count = 0
+        player_key = raiderio.character_key(realm, character_name)
+        if player_key in rows:
+            duplicates += 1
+            guild = guild or rows[player_key][2]
+        data_dict[player_key]['name'] = character_name
+        data_dict[player_key]['realm'] = realm
+        data_dict[player_key]['guild'] = guild
+        rows[player_key] = [character_name, realm, guild]
+    metrics.increment('characters_collapsed_total', duplicates, crawler='tournament')
+
+    # Reuse the previous results of unchanged rows while they are fresh
+    previous = await asyncio.to_thread(read_sync_state, state_path) if state_path else {}
+    fetched_at = {}  # Canonical character key -> time the stored scores were fetched
+    to_fetch = []
+    now = time.time()
+    for player_key, row in rows.items():
+        entry = previous.get(player_key)
+        if entry is not None and entry['row'] == row and entry['fetched_at'] and now - entry['fetched_at'] < SYNC_TTL:
+            data_dict[player_key].update(entry['record'])
+            fetched_at[player_key] = entry['fetched_at']
+        else:
+            to_fetch.append(player_key)
 
-        for character_name, realm, guild in data_array:
-            await process_player(session, realm, character_name, data_dict)
-            request_count += 1
-            
-            if request_count % 300 == 0:
-                await asyncio.sleep(1 * 60)
+    async def fetch_player(player_key):
+        character_name, realm, _ = rows[player_key]
+        async with sem:
+            if await process_player(session, realm, character_name, data_dict, cache, limiter, failed_urls):
+                fetched_at[player_key] = time.time()
 
-        for url in error_urls:
-            await fetch_data(session, url)  # Retry fetching data for URLs with errors
+    # Every character is fetched once, even if they signed up more than once
+    await asyncio.gather(*[fetch_player(player_key) for player_key in to_fetch])
+
+    # A stale result is still better than none when the new fetch failed
+    for player_key in to_fetch:
+        entry = previous.get(player_key)
+        if player_key not in fetched_at and entry is not None and entry['row'] == rows[player_key] and entry['fetched_at']:
+            data_dict[player_key].update(entry['record'])
+            fetched_at[player_key] = entry['fetched_at']
+
+    removed = len(set(previous) - set(rows))
+    print(f"Sign-ups: {len(rows)}, duplicates collapsed: {duplicates}, fetched: {len(to_fetch)}, reused: {len(rows) - len(to_fetch)}, removed: {removed}")
+    print(f"Requests that failed after all retries: {len(failed_urls)}")
 
-    output_file_path = r'C:\Users\Administrator\Desktop\tournament.json'
     output_dir = os.path.dirname(output_file_path)
 
-    if not os.path.exists(output_dir):
+    if output_dir and not os.path.exists(output_dir):
         os.makedirs(output_dir)  # Create output directory if it does not exist
 
     if data_dict:
-        with open(output_file_path, 'w', encoding='utf-8') as file:
-            json.dump(list(data_dict.values()), file, ensure_ascii=False, indent=2)  # Write data_dict to JSON file
+        await asyncio.to_thread(write_tournament_json, output_file_path, list(data_dict.values()))
     else:
         print("No data to write.")
 
-start_time = time.time()
-asyncio.run(main())  # Run the main function
-end_time = time.time()
-execution_time = end_time - start_time
-print(f"Execution time: {execution_time} seconds")  # Print execution time
+    if state_path:
+        entries = [
+            {'row': row, 'fetched_at': fetched_at.get(player_key), 'record': data_dict[player_key]}
+            for player_key, row in rows.items()
+        ]
+        await asyncio.to_thread(write_sync_state, state_path, entries)
+
+async def main(sheet_url=SHEET_URL, output_file_path=OUTPUT_PATH, state_path=STATE_PATH):
+    """
+    Main function to fetch and process player data from Google Sheets and Raider.io API.
+    """
+    data_array = get_data_array(sheet_url)  # Get data array from Google Sheets or a local CSV file
+    print(f"Sign-ups read: {len(data_array)}")
+    
+    limiter = raiderio.TokenBucket(REQUESTS_PER_WINDOW, WINDOW_SECONDS, BURST_SIZE)
+    cache = raiderio.ResponseCache()  # Shared with parser.py, so recently crawled profiles are not fetched again
+    connector = aiohttp.TCPConnector(ssl=False)  # Disable SSL certificate verification
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await crawl(session, data_array, cache, output_file_path, limiter, state_path)
+
+    print(cache.summary())
+    cache.close()
+
+    # Metrics summary of the crawl: request latency, response sizes, decode time, retries
+    print(metrics.summary())
+    metrics.write_prometheus(METRICS_PATH)
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description="Fetch Raider.io scores for the tournament sign-ups")
+    arguments.add_argument('--sheet', default=SHEET_URL, help="Sheet CSV export URL or a local CSV file")
+    arguments.add_argument('--output', default=OUTPUT_PATH)
+    arguments.add_argument('--state', default=STATE_PATH, help="Sync state file, only new, changed and stale rows are fetched")
+    arguments.add_argument('--full', action='store_true', help="Fetch every row and do not use the sync state")
+    args = arguments.parse_args()
+
+    start_time = time.time()
+    asyncio.run(main(args.sheet, args.output, None if args.full else args.state))  # Run the main function
+    end_time = time.time()
+    execution_time = end_time - start_time
+    print(f"Execution time: {execution_time} seconds")  # Print execution time
@@ -0,0 +1,319 @@
+import bisect
+import math
+import re
+import statistics
+from collections import defaultdict
+
+# Query logic behind the /rank and /tournament commands, kept apart from discord so it can be benchmarked
+
+VALID_CLASSES = {"all", "death knight", "demon hunter", "druid", "evoker", "hunter", "mage", "monk", "paladin", "priest", "rogue", "shaman", "warlock", "warrior"}
+VALID_ROLES = {"all", "dps", "healer", "tank"}
+
+# Snapshot file per /tournament format and whether its members are filtered by guild
+TOURNAMENT_SOURCES = {
+    "new": ('tournament.json', False),
+    "old": ('members.json', True),
+}
+
+# Specs of each class in the order of the raider.io spec_0 ... spec_3 scores, '/rank classes=mage:2' is Fire
+CLASS_SPECS = {
+    "death knight": ["blood", "frost", "unholy"],
+    "demon hunter": ["havoc", "vengeance"],
+    "druid": ["balance", "feral", "guardian", "restoration"],
+    "evoker": ["devastation", "preservation", "augmentation"],
+    "hunter": ["beast mastery", "marksmanship", "survival"],
+    "mage": ["arcane", "fire", "frost"],
+    "monk": ["brewmaster", "mistweaver", "windwalker"],
+    "paladin": ["holy", "protection", "retribution"],
+    "priest": ["discipline", "holy", "shadow"],
+    "rogue": ["assassination", "outlaw", "subtlety"],
+    "shaman": ["elemental", "enhancement", "restoration"],
+    "warlock": ["affliction", "demonology", "destruction"],
+    "warrior": ["arms", "fury", "protection"],
+}
+
+# Tank and healer specs, every other spec deals damage
+TANK_SPECS = {("death knight", "blood"), ("demon hunter", "vengeance"), ("druid", "guardian"), ("monk", "brewmaster"), ("paladin", "protection"), ("warrior", "protection")}
+HEALER_SPECS = {("druid", "restoration"), ("evoker", "preservation"), ("monk", "mistweaver"), ("paladin", "holy"), ("priest", "discipline"), ("priest", "holy"), ("shaman", "restoration")}
+
+# /guildstats settings
+ROLE_COLUMNS = {"tank": "rio_tank", "healer": "rio_healer", "dps": "rio_dps"}
+GUILD_STATS_THRESHOLD = 2500  # Members with a score at least this high are counted, overall and per role
+GUILD_STATS_SORTS = {"median": 'median', "mean": 'mean', "p90": 'p90', "best": 'best', "members": 'members', "strong": 'above'}  # Sort option -> statistic
+
+AUTOCOMPLETE_LIMIT = 25  # Most options Discord shows for an autocomplete
+
+WORD_START = re.compile(r"(?<!\w)\w")
+
+# Desired specs for melee and ranged DPS
+MELEE_SPECS = ["frost", "unholy", "havoc", "feral", "survival", "windwalker", "retribution", "assassination", "outlaw", "subtlety", "enhancement", "arms", "fury"]
+RANGED_SPECS = ["balance", "augmentation", "devastation", "beast mastery", "marksmanship", "arcane", "fire", "frost", "shadow", "elemental", "affliction", "demonology", "destruction"]
+
+# Raised with the message shown to the user when a query cannot be answered
+class QueryError(Exception):
+    pass
+
+# Function to answer a /rank query, returns the message to send
+def rank_query(snapshot, top=10, classes="all", guilds="all", role="all", rio=2000):
+    return rank_message(rank_leaders(snapshot, top, classes, guilds, role, rio), top, classes, guilds, role, rio)
+
+# Function to find the members of a /rank query, returns the score column and the members
+# The result only depends on rank_key() of the arguments, so it can be shared by queries that are spelled differently
+def rank_leaders(snapshot, top=10, classes="all", guilds="all", role="all", rio=2000):
+    # Checking the existence of data in the file
+    if not snapshot.members:
+        raise QueryError("No data to process. Complete the 'members.json' file before using this command.")
+
+    # Check for valid guild
+    input_guilds = None
+    positions = None
+    if guilds.lower() != "all":
+        input_guilds = [g.strip().lower() for g in guilds.split(',')]
+        positions = snapshot.select(guilds=input_guilds)
+        if len(positions) == 0:
+            raise QueryError("No members found for the given guild(s). Check the spelling or try different values.")
+
+    # Check for valid class
+    spec_number = 0
+    if ':' in classes.lower():
+        split_result = classes.split(':')
+        if len(split_result) == 2 and split_result[1].isdigit() and 1 <= int(split_result[1]) <= 4:
+            classes = split_result[0]
+            spec_number = int(split_result[1])
+            role = "all"
+        else:
+            raise QueryError("Wrong class format. Use the valid format: death knight:3 or warrior:1.")
+    else:
+        if (classes or "").lower() not in VALID_CLASSES:
+            raise QueryError(f"Class '{classes}' does not exist. Use the valid classes: all, death knight, demon hunter, druid, evoker, hunter, mage, monk, paladin, priest, rogue, shaman, warlock, warrior.")
+
+    # Check for valid role
+    if role.lower() not in VALID_ROLES:
+        raise QueryError(f"Role '{role}' does not exist. Use the valid roles: all, dps, healer, tank or spec name.")
+
+    # Check if top value is within the range of 1 to 50 inclusive
+    if not 1 <= top <= 50:
+        raise QueryError("Error: The value of top must be between 1 and 50 inclusive.")
+
+    # Check if rio value is within the range of 0 to 3500 inclusive
+    if not 0 <= rio <= 3500:
+        raise QueryError("Error: The value of rio must be between 0 and 3500 inclusive.")
+
+    # Filter by class
+    if (classes or "").lower() != "all":
+        positions = snapshot.select(guilds=input_guilds, class_name=classes.lower())
+
+    # Check whether the specification is entered
+    if spec_number == 0:
+        # Rate by the role, 'all' uses the overall rating
+        column = 'rio_' + role.lower()
+    else:
+        column = 'spec_' + str(spec_number - 1)
+
+    # Take the best members above the rio threshold
+    return column, snapshot.leaders(column, top, rio, positions=positions)
+
+# Function to format the members of a /rank query as they were asked for, returns the message to send
+def rank_message(leaders, top=10, classes="all", guilds="all", role="all", rio=2000):
+    column, members_data = leaders
+    if ':' in classes:
+        # A spec is shown with its class and the overall role
+        classes = classes.split(':')[0]
+        role = "all"
+
+    # Format header message
+    header_message = f"Top {top} | Classes -> {classes} | Guilds -> {guilds} | Role -> {role} | Rio > {rio}"
+
+    # Format the results
+    result_message = "\n".join([f"{i + 1}. {member['name']} ({member['guild']}, {member['realm']}) - {member['active_spec_name']} {member['class']} - RIO {role}: {member[column]}" for i, member in enumerate(members_data)])
+
+    return header_message + "\n------------------------------------------------------------\n" + result_message
+
+# Function to get the arguments of a /rank query in a form that is equal for queries with the same answer
+# Case, the order of the guilds and the spaces around them do not change the answer
+def rank_key(top=10, classes="all", guilds="all", role="all", rio=2000):
+    if guilds.lower() != "all":
+        guilds = tuple(sorted({g.strip().lower() for g in guilds.split(',')}))
+    else:
+        guilds = "all"
+    return (top, classes.lower(), guilds, role.lower(), rio)
+
+# Function to answer a /tournament query, returns the header and one message per category
+def tournament_query(snapshot, guild="Нехай Щастить", top=5, format="new"):
+    data_file, filter_guild = TOURNAMENT_SOURCES[format]
+
+    # Checking the existence of data in the file
+    if not snapshot.members:
+        raise QueryError(f"No data to process in '{data_file}'.")
+
+    if filter_guild:
+        # Filter by guild if needed
+        input_guilds = [guild.lower()]
+        guild_positions = snapshot.select(guilds=input_guilds)
+
+        if len(guild_positions) == 0:
+            raise QueryError(f"No data available for the guild '{guild}'.")
+    else:
+        # Use all members from the file
+        input_guilds = None
+        guild_positions = None
+
+    # Get top players for each category
+    top3_tank = snapshot.leaders('rio_tank', top, 1000, strict=False, positions=guild_positions)
+    top3_healer = snapshot.leaders('rio_healer', top, 1000, strict=False, positions=guild_positions)
+    melee_keys = [key for key in snapshot.class_specs() if key[1] in MELEE_SPECS and key[0] != 'mage']
+    ranged_keys = [key for key in snapshot.class_specs() if key[1] in RANGED_SPECS and key[0] != 'death knight']
+    top3_mdd = snapshot.leaders('rio_dps', top, positions=snapshot.select(guilds=input_guilds, class_specs=melee_keys))
+    top3_rdd = snapshot.leaders('rio_dps', top, positions=snapshot.select(guilds=input_guilds, class_specs=ranged_keys))
+
+    # Create a message for each category separately
+    categories = [
+        ("Tanks", top3_tank, "rio_tank"),
+        ("Healers", top3_healer, "rio_healer"),
+        ("Melee DPS", top3_mdd, "rio_dps"),
+        ("Ranged DPS", top3_rdd, "rio_dps"),
+    ]
+
+    result_messages = []
+    for category_name, top_players, rating_key in categories:
+        result_message = f"\n{category_name}:\n"
+        for i, member in enumerate(top_players):
+            if format == "new":
+                result_message += f"{i + 1}. {member['name']} ({member['guild']}) - {member['active_spec_name']} {member['class']} - {member.get(rating_key, 'N/A')}\n"
+            else:
+                result_message += f"{i + 1}. {member['name']} - {member['active_spec_name']} {member['class']} - {member.get(rating_key, 'N/A')}\n"
+        result_messages.append(result_message)
+
+    return f"Top {top} Players for the Tournament:", result_messages
+
+# Sorted prefix index for autocomplete: an option is found by the start of its name or of any word in it, case-insensitively
+# Lookups are a binary search plus the matching keys, so they stay fast with thousands of options
+class PrefixIndex:
+    def __init__(self, options):
+        keys = set()
+        for name, value in options:
+            folded = name.casefold()
+            for match in WORD_START.finditer(folded):
+                keys.add((folded[match.start():], name, value))
+        self.keys = sorted(keys)
+        self.names = sorted(set((name, value) for _, name, value in self.keys), key=lambda option: option[0].casefold())
+
+    # (name, value) options matching the prefix, names that start with it come before names with a word that does
+    def complete(self, prefix, limit=AUTOCOMPLETE_LIMIT):
+        prefix = prefix.strip().casefold()
+        if not prefix:
+            return self.names[:limit]
+        matches = {}
+        for i in range(bisect.bisect_left(self.keys, (prefix,)), len(self.keys)):
+            key, name, value = self.keys[i]
+            if not key.startswith(prefix):
+                break
+            matches[(name, value)] = None
+        options = sorted(matches, key=lambda option: (not option[0].casefold().startswith(prefix), option[0].casefold()))
+        return options[:limit]
+
+# Function to get the /rank classes options: every class and every class:spec number, named with the spec
+def class_options():
+    options = [("all", "all")]
+    for class_name, specs in sorted(CLASS_SPECS.items()):
+        options.append((class_name, class_name))
+        for number, spec in enumerate(specs, start=1):
+            options.append((f"{class_name}:{number} ({spec})", f"{class_name}:{number}"))
+    return options
+
+# Function to get the /rank guilds options from guild names, 'None' matches members without a guild
+def guild_options(guild_names):
+    return [("all", "all"), ("None", "None")] + [(name, name) for name in guild_names]
+
+# Function to get the role of a (lowercased class, lowercased spec) pair
+def spec_role(class_spec):
+    if class_spec in TANK_SPECS:
+        return "tank"
+    if class_spec in HEALER_SPECS:
+        return "healer"
+    return "dps"
+
+# Function to get the score at a fraction of a sorted list of scores, by the nearest rank
+def percentile(sorted_scores, fraction):
+    return sorted_scores[max(0, math.ceil(fraction * len(sorted_scores)) - 1)]
+
+# Function to compute the statistics of every guild of a snapshot, done once per snapshot: lowercased guild -> statistics
+# Score statistics only count members with a score, counts per role follow the active spec
+def guild_stats(snapshot):
+    stats = {}
+    for name in sorted(snapshot.guild_names):
+        if name.lower() in stats:
+            continue
+        positions = snapshot.select(guilds=[name.lower()])
+        scores = sorted(score for score in snapshot.scores('rio_all', positions) if score > 0)
+        specs = snapshot.class_spec_counts(positions)
+        roles = {role: 0 for role in ROLE_COLUMNS}
+        classes = defaultdict(int)
+        for class_spec, count in specs.items():
+            roles[spec_role(class_spec)] += count
+            classes[class_spec[0]] += count
+        stats[name.lower()] = {
+            'name': name,
+            'members': len(positions),
+            'scored': len(scores),
+            'mean': sum(scores) / len(scores) if scores else 0,
+            'median': statistics.median(scores) if scores else 0,
+            'p90': percentile(scores, 0.9) if scores else 0,
+            'best': scores[-1] if scores else 0,
+            'above': sum(score >= GUILD_STATS_THRESHOLD for score in scores),
+            'roles': roles,
+            'strong': {
+                role: sum(score >= GUILD_STATS_THRESHOLD for score in snapshot.scores(column, positions))
+                for role, column in ROLE_COLUMNS.items()
+            },
+            'top': {role: next(iter(snapshot.leaders(column, 1, 0, positions=positions)), None) for role, column in ROLE_COLUMNS.items()},
+            'classes': dict(classes),
+            'specs': specs,
+        }
+    return stats
+
+# Function to answer a /guildstats query from the precomputed statistics, returns the message to send
+def guildstats_query(stats, guild="all", sort="median"):
+    # Checking the existence of data in the file
+    if not stats:
+        raise QueryError("No data to process. Complete the 'members.json' file before using this command.")
+
+    # Check for valid sort
+    if sort.lower() not in GUILD_STATS_SORTS:
+        raise QueryError(f"Sort '{sort}' does not exist. Use the valid sorts: {', '.join(GUILD_STATS_SORTS)}.")
+
+    threshold = GUILD_STATS_THRESHOLD
+    if guild.strip().lower() == "all":
+        # Compare every guild, one line each
+        field = GUILD_STATS_SORTS[sort.lower()]
+        guilds = sorted(stats.values(), key=lambda guild_stat: (-guild_stat[field], guild_stat['name'].lower()))
+        header_message = f"Guilds by {sort.lower()} | RIO of members with a score | {threshold}+: members with at least {threshold} RIO"
+        lines = [
+            f"{i + 1}. {g['name']} - {g['members']} members | median {g['median']:.1f} | mean {g['mean']:.1f} | "
+            f"p90 {g['p90']:.1f} | best {g['best']:.1f} | {threshold}+ {g['above']} "
+            f"(tanks {g['strong']['tank']}, healers {g['strong']['healer']}, dps {g['strong']['dps']})"
+            for i, g in enumerate(guilds)
+        ]
+        return header_message + "\n------------------------------------------------------------\n" + "\n".join(lines)
+
+    # Check for valid guild
+    g = stats.get(guild.strip().lower())
+    if g is None:
+        raise QueryError(f"No members found for the guild '{guild}'. Check the spelling or try different values.")
+
+    lines = [
+        f"Members: {g['members']}, with a M+ score: {g['scored']}",
+        f"RIO: mean {g['mean']:.1f} | median {g['median']:.1f} | p90 {g['p90']:.1f} | best {g['best']:.1f}",
+        f"Roles by active spec: tanks {g['roles']['tank']} | healers {g['roles']['healer']} | dps {g['roles']['dps']}",
+        f"RIO {threshold}+: all {g['above']} | tanks {g['strong']['tank']} | healers {g['strong']['healer']} | dps {g['strong']['dps']}",
+    ]
+    for role, column in ROLE_COLUMNS.items():
+        member = g['top'][role]
+        if member is not None:
+            lines.append(f"Best {role}: {member['name']} ({member['realm']}) - {member['active_spec_name']} {member['class']} - RIO {role}: {member[column]}")
+    classes = sorted(g['classes'].items(), key=lambda item: (-item[1], item[0]))
+    lines.append("Classes: " + ", ".join(f"{class_name} {count}" for class_name, count in classes))
+    specs = sorted(g['specs'].items(), key=lambda item: (-item[1], item[0]))
+    lines.append("Specs: " + ", ".join(f"{spec} {class_name} {count}" for (class_name, spec), count in specs))
+
+    return f"Guild stats | {g['name']}" + "\n------------------------------------------------------------\n" + "\n".join(lines)
@@ -0,0 +1,310 @@
+import aiohttp
+import asyncio
+import contextlib
+import json
+import random
+import re
+import sqlite3
+import time
+import unicodedata
+from email.utils import parsedate_to_datetime
+from urllib.parse import parse_qsl, unquote, urlencode, urlsplit
+
+import fastjson
+import metrics
+
+API_BASE = "http://raider.io"
+
+# Response cache settings shared by parser.py and parser_tournament.py
+CACHE_PATH = "raiderio_cache.sqlite3"
+CACHE_TTLS = {
+    "/api/v1/characters/profile": 6 * 60 * 60,  # Seconds a cached response stays fresh, per endpoint
+    "/api/v1/guilds/profile": 60 * 60,
+}
+CACHE_MAX_ENTRIES = 200000  # Least recently used entries above this limit are evicted
+CACHE_COMMIT_EVERY = 100  # Writes batched into one transaction
+CACHE_BUSY_TIMEOUT = 30  # Seconds to wait for another process that is writing to the cache
+
+# Pooled HTTP client settings used by the bot
+HTTP_LIMIT_PER_HOST = 10  # Concurrent connections to raider.io
+HTTP_DNS_CACHE_TTL = 5 * 60  # Seconds resolved addresses are reused
+HTTP_KEEPALIVE_TIMEOUT = 60  # Seconds idle connections are kept open
+HTTP_TIMEOUT = 30  # Seconds for a whole request
+HTTP_CONNECT_TIMEOUT = 10  # Seconds to get a connection from the pool and connect
+
+# Retry settings for transient errors: timeouts, dropped connections, 429 and 5xx responses
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 2  # Seconds before the first retry, doubled on every further attempt
+RETRY_MAX_DELAY = 5 * 60
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Token bucket shared by all workers so a crawl never exceeds the raider.io quota
+class TokenBucket:
+    def __init__(self, requests_per_window, window_seconds, burst_size):
+        if not 0 < burst_size < requests_per_window:
+            raise ValueError("burst_size must be greater than 0 and less than requests_per_window")
+        # A full bucket plus one window of refill must still fit into the quota
+        self.rate = (requests_per_window - burst_size) / window_seconds
+        self.capacity = burst_size
+        self.tokens = burst_size
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+        self.acquired = 0  # Total number of requests let through
+        self.paused_until = 0
+
+    # Stop letting requests through for the given number of seconds
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        # Start refilling from empty once the pause is over
+        self.tokens = 0
+        self.updated = self.paused_until
+
+    # Wait until a token is available and take it
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.acquired += 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# Long-lived pooled HTTP client that counts the requests it has in flight
+class HttpClient:
+    def __init__(self, limit_per_host=HTTP_LIMIT_PER_HOST, dns_cache_ttl=HTTP_DNS_CACHE_TTL,
+                 keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT, timeout=HTTP_TIMEOUT, connect_timeout=HTTP_CONNECT_TIMEOUT,
+                 trace_configs=None):
+        connector = aiohttp.TCPConnector(
+            ssl=False,
+            limit_per_host=limit_per_host,
+            ttl_dns_cache=dns_cache_ttl,
+            keepalive_timeout=keepalive_timeout
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=timeout, connect=connect_timeout),
+            trace_configs=trace_configs
+        )
+        self.requests = 0  # Total number of requests sent
+        self.in_flight = 0  # Requests waiting for a connection or a response
+        self.peak_in_flight = 0
+
+    # Send a GET request, counting it while it is in flight
+    @contextlib.asynccontextmanager
+    async def get(self, url):
+        self.requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        endpoint = urlsplit(url).path.rstrip("/")
+        start_time = time.perf_counter()
+        try:
+            async with self.session.get(url) as response:
+                # Time until the response headers arrived, the body is read by the caller
+                metrics.observe('http_request_seconds', time.perf_counter() - start_time, endpoint=endpoint)
+                metrics.increment('http_responses_total', endpoint=endpoint, status=response.status)
+                yield response
+        except Exception as e:
+            metrics.increment('http_errors_total', endpoint=endpoint, error=type(e).__name__)
+            raise
+        finally:
+            self.in_flight -= 1
+
+    async def close(self):
+        await self.session.close()
+
+    def summary(self):
+        return f"HTTP: {self.requests} requests, {self.in_flight} in flight, peak {self.peak_in_flight}"
+
+# Function to build the character profile URL, identical for both parsers so their cache entries are shared
+def character_profile_url(realm, name, region="eu"):
+    return f"{API_BASE}/api/v1/characters/profile?region={region}&realm={realm}&name={name}&fields=mythic_plus_scores_by_season:current,class,active_spec_name"
+
+# Function to turn a realm into a slug: "Tarren Mill", "tarren-mill" and "Tarren%20Mill" all give "tarren-mill"
+def realm_slug(realm):
+    realm = unicodedata.normalize('NFC', unquote(realm)).casefold().replace("'", "")
+    return re.sub(r"[\s_-]+", "-", realm).strip("-")
+
+# Function to get the canonical key of a character: region, realm slug and the NFC-normalized, case-folded name
+# Every loader keys its characters by it, so spellings of the same character are fetched and stored once
+def character_key(realm, name, region="eu"):
+    return (region.strip().lower(), realm_slug(realm), unicodedata.normalize('NFC', unquote(name).strip()).casefold())
+
+# Function to turn a URL into a cache key: host and scheme are dropped, parameters are decoded, lowercased and sorted
+def normalize_url(url):
+    parts = urlsplit(url)
+    query = []
+    for key, value in parse_qsl(parts.query, keep_blank_values=True):
+        key = key.lower()
+        value = value.strip().lower()
+        if key == "fields":
+            value = ",".join(sorted(value.split(",")))
+        query.append((key, value))
+    return parts.path.rstrip("/") + "?" + urlencode(sorted(query))
+
+# Persistent SQLite cache of successful raider.io responses
+class ResponseCache:
+    # Processes sharing the file should commit every write, an open transaction locks the others out
+    def __init__(self, path=CACHE_PATH, ttls=CACHE_TTLS, max_entries=CACHE_MAX_ENTRIES, commit_every=CACHE_COMMIT_EVERY):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.pending_writes = 0
+        self.connection = sqlite3.connect(path, timeout=CACHE_BUSY_TIMEOUT)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, body TEXT NOT NULL, fetched_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+
+    # Seconds a response from this URL stays fresh, or None if the endpoint is not cached
+    def ttl(self, url):
+        return self.ttls.get(urlsplit(url).path.rstrip("/"))
+
+    # Return the cached data for the URL or None if it is missing or stale
+    def get(self, url):
+        ttl = self.ttl(url)
+        if ttl is None:
+            return None
+        key = normalize_url(url)
+        row = self.connection.execute("SELECT body, fetched_at FROM responses WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or now - row[1] > ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        self._written()
+        return fastjson.loads(row[0])
+
+    # Store the data for the URL if its endpoint is cached
+    def put(self, url, data):
+        if self.ttl(url) is None:
+            return
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses (key, body, fetched_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (normalize_url(url), json.dumps(data, ensure_ascii=False), now, now)
+        )
+        self._written()
+
+    def _written(self):
+        self.pending_writes += 1
+        if self.pending_writes >= self.commit_every:
+            self.flush()
+
+    # Evict least recently used entries above the size limit and commit pending writes
+    def flush(self):
+        count = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,)
+            )
+            self.evictions += count - self.max_entries
+        self.connection.commit()
+        self.pending_writes = 0
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def summary(self):
+        return f"Cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions"
+
+# Function to get the delay requested by a Retry-After header, in seconds or as an HTTP date
+def retry_after_delay(headers):
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+# Function to get the time until the rate limit window resets once no requests are left in it
+def rate_limit_delay(headers):
+    if headers.get('X-RateLimit-Remaining') != '0':
+        return None
+    try:
+        reset = float(headers.get('X-RateLimit-Reset', ''))
+    except ValueError:
+        return None
+    # The reset is either a Unix timestamp or a number of seconds
+    return max(reset - time.time(), 0) if reset > 1e9 else reset
+
+# Function to get the wait before the next attempt: exponential backoff with jitter, at least what the server asked for
+def backoff_delay(attempt, requested=None):
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    return max(delay, requested or 0)
+
+# Asynchronous function to fetch data from a given URL, served from the cache when it is fresh
+# Transient errors are retried with backoff, client errors such as 400 "not found" are returned as they are
+# URLs that still failed are appended to failed_urls, a list kept by each crawl
+@metrics.timed('raiderio_fetch_seconds')
+async def fetch_data(session, url, limiter=None, cache=None, max_attempts=RETRY_MAX_ATTEMPTS, failed_urls=None):
+    endpoint = urlsplit(url).path.rstrip("/")
+    if cache is not None:
+        data = cache.get(url)
+        if data is not None:
+            metrics.increment('raiderio_cache_hits_total', endpoint=endpoint)
+            return data
+
+    for attempt in range(1, max_attempts + 1):
+        if limiter is not None:
+            await limiter.acquire()
+        requested = None
+        start_time = time.perf_counter()
+        try:
+            async with session.get(url) as response:
+                metrics.observe('raiderio_request_seconds', time.perf_counter() - start_time, endpoint=endpoint)
+                metrics.increment('raiderio_responses_total', endpoint=endpoint, status=response.status)
+
+                # Hold back the whole crawl, not only this request, when raider.io asks for it
+                requested = retry_after_delay(response.headers) or rate_limit_delay(response.headers)
+                if requested and limiter is not None:
+                    limiter.pause(requested)
+
+                if response.status not in RETRYABLE_STATUSES:
+                    metrics.observe('raiderio_response_bytes', len(await response.read()), metrics.SIZE_BUCKETS, endpoint=endpoint)
+                    with metrics.timer('raiderio_json_decode_seconds', endpoint=endpoint):
+                        data = await fastjson.read_json(response)
+                    if cache is not None and response.status == 200:
+                        cache.put(url, data)
+                    return data
+                error = f"HTTP {response.status}"
+        except Exception as e:
+            metrics.increment('raiderio_errors_total', endpoint=endpoint, error=type(e).__name__)
+            if 400 <= getattr(e, 'status', 0) < 500:
+                # A client error without a JSON body will not get better on a retry
+                print(f"Error fetching data from {url}: {e}")
+                if failed_urls is not None:
+                    failed_urls.append(url)
+                return None
+            error = e
+
+        if attempt < max_attempts:
+            metrics.increment('raiderio_retries_total', endpoint=endpoint)
+            delay = backoff_delay(attempt, requested)
+            print(f"Error fetching data from {url}: {error}, retrying in {delay:.1f} seconds")
+            await asyncio.sleep(delay)
+
+    print(f"Error fetching data from {url}: {error}, giving up after {max_attempts} attempts")
+    metrics.increment('raiderio_failures_total', endpoint=endpoint)
+    if failed_urls is not None:
+        failed_urls.append(url)
+    return None
@@ -0,0 +1,475 @@
+import contextlib
+import heapq
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from array import array
+from collections import defaultdict
+from collections.abc import Sequence
+
+import fastjson
+import metrics
+
+try:
+    import numpy
+except ImportError:  # Optional, queries fall back to the Python indexes
+    numpy = None
+
+# Score columns that get a presorted leaderboard
+SCORE_COLUMNS = ('rio_all', 'rio_dps', 'rio_healer', 'rio_tank', 'spec_0', 'spec_1', 'spec_2', 'spec_3')
+
+# Snapshots with at least this many members are queried through a NumPy table when NumPy is installed
+COLUMNAR_MIN_MEMBERS = 5000
+
+# Binary snapshot written next to each JSON snapshot, little-endian:
+# header, one float64 block per score column, one uint32 string id block per string field,
+# a present and an integer bitmask byte per member, then the string table offsets and UTF-8 bytes
+# Every block starts on an 8-byte boundary so it can be used straight from the memory map
+BINARY_MAGIC = b'UAWB'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sIII')  # Magic, format version, member count, string count
+STRING_FIELDS = ('name', 'realm', 'guild', 'class', 'active_spec_name')
+NONE_ID = 0xFFFFFFFF  # String id of a missing or None value
+
+# Function to get the score of a member in a column, missing and negative scores count as 0
+def member_score(member, column):
+    return max(member.get(column, 0), 0)
+
+# Function to get the version of a snapshot file, it changes whenever the file is rewritten
+def file_version(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+# Function to get the path of a version of the binary snapshot that belongs to a JSON snapshot, members.json -> members.<stamp>.bin
+# Every write makes a new version, so no write has to replace a file a reader has memory-mapped, which Windows refuses
+def binary_path(path, stamp):
+    return f"{os.path.splitext(path)[0]}.{stamp}.bin"
+
+# Function to get the stamps of the binary snapshot versions of a JSON snapshot, oldest first
+def binary_stamps(path):
+    prefix = os.path.basename(os.path.splitext(path)[0]) + '.'
+    stamps = []
+    for entry in os.listdir(os.path.dirname(path) or '.'):
+        stamp = entry[len(prefix):-len('.bin')]
+        if entry.startswith(prefix) and entry.endswith('.bin') and stamp.isdigit():
+            stamps.append(int(stamp))
+    return sorted(stamps)
+
+# Function to get the path of the newest binary snapshot of a JSON snapshot, None if there is none
+def latest_binary(path):
+    stamps = binary_stamps(path)
+    return binary_path(path, stamps[-1]) if stamps else None
+
+# Function to get the offset, type code and length of every block of a binary snapshot
+def binary_layout(count, string_count, string_bytes=0):
+    blocks = [(column, 'd', count) for column in SCORE_COLUMNS]
+    blocks += [(field, 'I', count) for field in STRING_FIELDS]
+    blocks += [('present', 'B', count), ('integer', 'B', count), ('offsets', 'I', string_count + 1), ('strings', 'B', string_bytes)]
+    layout = {}
+    offset = BINARY_HEADER.size
+    for name, type_code, length in blocks:
+        layout[name] = (offset, type_code, length)
+        offset += -(-length * array(type_code).itemsize // 8) * 8
+    return layout
+
+# Function to write members as a binary snapshot, replacing the file at once, returns the member count or 0 if it could not be written
+# Fields other than the score columns and STRING_FIELDS are not kept
+# Every writer uses its own temporary file, so a crawl and the bot converting the same snapshot do not write over each other
+def write_binary_snapshot(path, members):
+    blocks = {column: array('d') for column in SCORE_COLUMNS}
+    blocks.update({field: array('I') for field in STRING_FIELDS})
+    blocks['present'] = array('B')
+    blocks['integer'] = array('B')
+    string_ids = {}
+    for member in members:
+        for field in STRING_FIELDS:
+            value = member.get(field)
+            blocks[field].append(NONE_ID if value is None else string_ids.setdefault(value, len(string_ids)))
+        present = integer = 0
+        for bit, column in enumerate(SCORE_COLUMNS):
+            value = member.get(column)
+            if value is not None:
+                present |= 1 << bit
+                if isinstance(value, int):
+                    integer |= 1 << bit
+            blocks[column].append(value or 0)
+        blocks['present'].append(present)
+        blocks['integer'].append(integer)
+
+    encoded = [value.encode('utf-8') for value in string_ids]
+    blocks['offsets'] = array('I', [0])
+    for value in encoded:
+        blocks['offsets'].append(blocks['offsets'][-1] + len(value))
+    blocks['strings'] = array('B', b''.join(encoded))
+
+    count = len(blocks['present'])
+    temp_path = None
+    try:
+        descriptor, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path) or '.')
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, count, len(encoded)))
+            for name, (offset, type_code, length) in binary_layout(count, len(encoded), len(blocks['strings'])).items():
+                if sys.byteorder == 'big':
+                    blocks[name].byteswap()
+                file.write(b'\0' * (offset - file.tell()))
+                file.write(blocks[name].tobytes())
+        os.replace(temp_path, path)
+    except OSError as e:
+        if temp_path is not None:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+        print(f"Could not write '{path}': {e}, it will be written again next time.")
+        return 0
+    return count
+
+# Function to write members as a new version of the binary snapshot of a JSON snapshot, returns the member count or 0
+# Older versions are removed, one a reader still has mapped on Windows is removed by a later write instead
+def publish_binary_snapshot(path, members):
+    stamp = time.time_ns()
+    count = write_binary_snapshot(binary_path(path, stamp), members)
+    if count:
+        for old_stamp in binary_stamps(path):
+            if old_stamp < stamp:
+                with contextlib.suppress(OSError):
+                    os.remove(binary_path(path, old_stamp))
+    return count
+
+# Function to write the binary snapshot of a JSON snapshot, returns the member count or 0 if it could not be written
+def convert_snapshot(path):
+    return publish_binary_snapshot(path, fastjson.load(path))
+
+# Read-only member list backed by a memory-mapped binary snapshot, members are decoded only when accessed
+class BinaryMembers(Sequence):
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, string_count = BINARY_HEADER.unpack_from(self.buffer)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError(f"'{path}' is not a binary snapshot of version {BINARY_VERSION}")
+        if sys.byteorder != 'little':
+            raise ValueError("Binary snapshots can only be read on little-endian machines")
+
+        strings_offset, _, _ = binary_layout(self.count, string_count)['strings']
+        self.layout = binary_layout(self.count, string_count, len(self.buffer) - strings_offset)
+        view = memoryview(self.buffer)
+        self.blocks = {}
+        for name, (offset, type_code, length) in self.layout.items():
+            self.blocks[name] = view[offset:offset + length * array(type_code).itemsize].cast(type_code)
+
+    # Decode the string with the given id, None for NONE_ID
+    def string(self, string_id):
+        if string_id == NONE_ID:
+            return None
+        offsets = self.blocks['offsets']
+        return bytes(self.blocks['strings'][offsets[string_id]:offsets[string_id + 1]]).decode('utf-8')
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not -self.count <= i < self.count:
+            raise IndexError("member index out of range")
+        i %= self.count
+        member = {field: self.string(self.blocks[field][i]) for field in STRING_FIELDS}
+        present = self.blocks['present'][i]
+        integer = self.blocks['integer'][i]
+        for bit, column in enumerate(SCORE_COLUMNS):
+            if present >> bit & 1:
+                value = self.blocks[column][i]
+                member[column] = int(value) if integer >> bit & 1 else value
+        return member
+
+# Function to turn a list of values into integer codes, returns the value -> code mapping and the code array
+def encode(values):
+    codes = {}
+    encoded = numpy.fromiter((codes.setdefault(value, len(codes)) for value in values), dtype=numpy.int32, count=len(values))
+    return codes, encoded
+
+# Function to turn string ids of a binary snapshot into codes of the lowercased strings
+def encode_ids(members, ids):
+    unique, inverse = numpy.unique(ids, return_inverse=True)
+    codes = {}
+    lowered = [codes.setdefault((members.string(string_id) or "").lower(), len(codes)) for string_id in unique.tolist()]
+    return codes, numpy.array(lowered, dtype=numpy.int32)[inverse]
+
+# Function to get the distinct guild names of the members as they are written in the file
+def guild_names(members):
+    if isinstance(members, BinaryMembers):
+        ids = members.blocks['guild']
+        unique = numpy.unique(numpy.frombuffer(ids, dtype=numpy.uint32)).tolist() if numpy is not None else set(ids)
+        names = {members.string(string_id) for string_id in unique}
+    else:
+        names = {member.get('guild') for member in members}
+    return names - {None, ""}
+
+# Columnar copy of the filter and score fields: float score arrays and dictionary-encoded guild, class and spec
+class MemberTable:
+    def __init__(self, guild_codes, guilds, no_guild, class_codes, classes, class_spec_codes, class_specs, scores):
+        self.guild_codes = guild_codes  # Lowercased guild -> code
+        self.guilds = guilds
+        self.no_guild = no_guild  # True for members without a guild
+        self.class_codes = class_codes  # Lowercased class -> code
+        self.classes = classes
+        self.class_spec_codes = class_spec_codes  # (lowercased class, lowercased active spec) -> code
+        self.class_specs = class_specs
+        self.scores = scores  # Score column -> float64 array, missing and negative scores are 0
+
+    @classmethod
+    def from_members(cls, members):
+        guild_codes, guilds = encode([(member.get('guild') or "").lower() for member in members])
+        class_codes, classes = encode([(member.get('class') or "").lower() for member in members])
+        class_spec_codes, class_specs = encode([
+            ((member.get('class') or "").lower(), (member.get('active_spec_name') or "").lower()) for member in members
+        ])
+        return cls(
+            guild_codes, guilds,
+            numpy.fromiter((member.get('guild') is None for member in members), dtype=bool, count=len(members)),
+            class_codes, classes, class_spec_codes, class_specs,
+            {
+                column: numpy.fromiter((member_score(member, column) for member in members), dtype=numpy.float64, count=len(members))
+                for column in SCORE_COLUMNS
+            }
+        )
+
+    # Build the table from the blocks of a binary snapshot, the score arrays stay in the memory map
+    @classmethod
+    def from_binary(cls, members):
+        ids = {field: numpy.frombuffer(members.blocks[field], dtype=numpy.uint32) for field in ('guild', 'class', 'active_spec_name')}
+        guild_codes, guilds = encode_ids(members, ids['guild'])
+        class_codes, classes = encode_ids(members, ids['class'])
+        spec_codes, specs = encode_ids(members, ids['active_spec_name'])
+
+        # Pair codes are class code * spec count + spec code, only pairs that occur are listed
+        pairs = classes.astype(numpy.int64) * len(spec_codes) + specs
+        class_names = list(class_codes)
+        spec_names = list(spec_codes)
+        class_spec_codes = {
+            (class_names[pair // len(spec_codes)], spec_names[pair % len(spec_codes)]): pair
+            for pair in numpy.unique(pairs).tolist()
+        }
+
+        scores = {}
+        for column in SCORE_COLUMNS:
+            score = numpy.frombuffer(members.blocks[column], dtype=numpy.float64)
+            scores[column] = numpy.maximum(score, 0) if (score < 0).any() else score
+        return cls(guild_codes, guilds, ids['guild'] == NONE_ID, class_codes, classes, class_spec_codes, pairs, scores)
+
+    # Positions of the members matching all given filters, in file order, None when no filter is given
+    def select(self, guilds=None, class_name=None, class_specs=None):
+        mask = None
+        if guilds is not None:
+            mask = self._isin(self.guilds, self.guild_codes, guilds)
+            if 'none' in guilds:
+                mask |= self.no_guild
+        if class_name is not None:
+            mask = self._and(mask, self._isin(self.classes, self.class_codes, [class_name]))
+        if class_specs is not None:
+            mask = self._and(mask, self._isin(self.class_specs, self.class_spec_codes, class_specs))
+        if mask is None:
+            return None
+        return numpy.flatnonzero(mask)
+
+    # Positions of up to `count` members with the best scores in the column, best first, ties keep file order
+    def leaders(self, column, count, threshold=None, strict=True, positions=None):
+        scores = self.scores[column]
+        if positions is None:
+            positions = numpy.arange(len(scores))
+        candidate_scores = scores[positions]
+        if threshold is not None:
+            keep = candidate_scores > threshold if strict else candidate_scores >= threshold
+            positions, candidate_scores = positions[keep], candidate_scores[keep]
+
+        if count <= 0:
+            return positions[:0]
+        if len(positions) > count:
+            # Keep every score tied with the last place, the final sort then picks the earliest of them
+            kth = candidate_scores[numpy.argpartition(-candidate_scores, count - 1)[count - 1]]
+            keep = candidate_scores >= kth
+            positions, candidate_scores = positions[keep], candidate_scores[keep]
+        return positions[numpy.lexsort((positions, -candidate_scores))][:count]
+
+    # Member count per (lowercased class, lowercased spec) among the positions
+    def class_spec_counts(self, positions):
+        names = {code: key for key, code in self.class_spec_codes.items()}
+        codes, counts = numpy.unique(self.class_specs[positions], return_counts=True)
+        return {names[code]: count for code, count in zip(codes.tolist(), counts.tolist())}
+
+    @staticmethod
+    def _isin(array, codes, values):
+        wanted = [codes[value] for value in values if value in codes]
+        return numpy.isin(array, wanted)
+
+    @staticmethod
+    def _and(mask, other):
+        if mask is None:
+            return other
+        return mask & other
+
+# Members of one snapshot file with indexes for the guild, class and spec filters
+class Snapshot:
+    def __init__(self, members, version):
+        self.members = members
+        self.version = version
+        self.guild_names = guild_names(members)  # For the autocomplete of guild arguments
+
+        # Large snapshots use the columnar table instead of the Python indexes below
+        self.table = None
+        if numpy is not None and len(members) >= COLUMNAR_MIN_MEMBERS:
+            if isinstance(members, BinaryMembers):
+                self.table = MemberTable.from_binary(members)
+            else:
+                self.table = MemberTable.from_members(members)
+            return
+        if isinstance(members, BinaryMembers):
+            # The Python indexes read every member many times, so decode them once
+            self.members = members = list(members)
+
+        # Indexes hold member positions in file order
+        self.by_guild = defaultdict(list)  # Lowercased guild -> positions
+        self.no_guild = []  # Positions of members without a guild
+        self.by_class = defaultdict(list)  # Lowercased class -> positions
+        self.by_class_spec = defaultdict(list)  # (lowercased class, lowercased active spec) -> positions
+        for i, member in enumerate(members):
+            guild = member.get('guild')
+            class_ = (member.get('class') or "").lower()
+            if guild is None:
+                self.no_guild.append(i)
+            self.by_guild[(guild or "").lower()].append(i)
+            self.by_class[class_].append(i)
+            self.by_class_spec[(class_, (member.get('active_spec_name') or "").lower())].append(i)
+
+        # Member positions per score column, best first; ties keep file order
+        self.leaderboards = {}
+        for column in SCORE_COLUMNS:
+            scores = [member_score(member, column) for member in members]
+            self.leaderboards[column] = sorted(range(len(members)), key=scores.__getitem__, reverse=True)
+
+    # (lowercased class, lowercased spec) pairs present in the snapshot
+    def class_specs(self):
+        if self.table is not None:
+            return list(self.table.class_spec_codes)
+        return list(self.by_class_spec)
+
+    # Positions of the members matching all given filters, in file order, None when no filter is given
+    # guilds: lowercased guild names, 'none' also matches members without a guild
+    # class_name: lowercased class
+    # class_specs: (lowercased class, lowercased spec) pairs
+    def select(self, guilds=None, class_name=None, class_specs=None):
+        if self.table is not None:
+            return self.table.select(guilds, class_name, class_specs)
+
+        positions = None
+        if guilds is not None:
+            positions = set()
+            for guild in guilds:
+                positions.update(self.by_guild.get(guild, ()))
+            if 'none' in guilds:
+                positions.update(self.no_guild)
+        if class_name is not None:
+            positions = self._intersect(positions, self.by_class.get(class_name, ()))
+        if class_specs is not None:
+            matched = set()
+            for key in class_specs:
+                matched.update(self.by_class_spec.get(key, ()))
+            positions = self._intersect(positions, matched)
+        if positions is None:
+            return None
+        return sorted(positions)
+
+    # Up to `count` members with the best scores in the column, best first, ties keep file order
+    # threshold: only scores above it (or equal to it if not strict) are kept, None keeps every score
+    # positions: subset from select(), without it every member is ranked
+    def leaders(self, column, count, threshold=None, strict=True, positions=None):
+        if self.table is not None:
+            return [self.members[i] for i in self.table.leaders(column, count, threshold, strict, positions).tolist()]
+
+        def passes(score):
+            return threshold is None or score > threshold or (not strict and score == threshold)
+
+        if positions is None:
+            result = []
+            for i in self.leaderboards[column]:
+                member = self.members[i]
+                # Scores only go down from here, so the walk stops at the first one below the threshold
+                if len(result) == count or not passes(member_score(member, column)):
+                    break
+                result.append(member)
+            return result
+
+        best = heapq.nlargest(count, positions, key=lambda i: member_score(self.members[i], column))
+        return [self.members[i] for i in best if passes(member_score(self.members[i], column))]
+
+    # Scores in the column of the members at the positions, in the same order
+    def scores(self, column, positions):
+        if self.table is not None:
+            return self.table.scores[column][positions].tolist()
+        return [member_score(self.members[i], column) for i in positions]
+
+    # Member count per (lowercased class, lowercased spec) among the positions
+    def class_spec_counts(self, positions):
+        if self.table is not None:
+            return self.table.class_spec_counts(positions)
+        counts = defaultdict(int)
+        for i in positions:
+            member = self.members[i]
+            counts[((member.get('class') or "").lower(), (member.get('active_spec_name') or "").lower())] += 1
+        return dict(counts)
+
+    @staticmethod
+    def _intersect(positions, other):
+        if positions is None:
+            return set(other)
+        return positions.intersection(other)
+
+# Keeps each snapshot file in memory and reloads it only when the file changes
+class MemberStore:
+    def __init__(self, executor=None):
+        self.snapshots = {}  # Path -> Snapshot
+        # Process pool that turns JSON snapshots without a fresh binary snapshot into one, so the JSON decode
+        # holds the GIL of that process instead of this one; None decodes the JSON here
+        self.executor = executor
+
+    # Return the loaded snapshot if the file has not changed since, otherwise None
+    def cached(self, path):
+        snapshot = self.snapshots.get(path)
+        if snapshot is not None and snapshot.version == file_version(path):
+            return snapshot
+        return None
+
+    # Read the file into a new snapshot and keep it
+    # The newest binary snapshot of the JSON file is memory-mapped instead when it is at least as new
+    def load(self, path):
+        version = file_version(path)  # Taken before reading, so a write during the read triggers another reload
+        snapshot = None
+        binary = latest_binary(path)
+        if self.executor is not None and not self._binary_fresh(binary, version):
+            try:
+                with metrics.timer('snapshot_convert_seconds'):
+                    self.executor.submit(convert_snapshot, path).result()
+            except Exception as e:
+                print(f"Error converting '{path}': {e}, reading it here instead")
+            binary = latest_binary(path)
+        if self._binary_fresh(binary, version):
+            try:
+                with metrics.timer('snapshot_load_seconds', format='binary'):
+                    snapshot = Snapshot(BinaryMembers(binary), version)
+            except (OSError, ValueError) as e:
+                print(f"Error reading '{binary}': {e}, reading '{path}' instead")
+        if snapshot is None:
+            with metrics.timer('snapshot_load_seconds', format='json'):
+                snapshot = Snapshot(fastjson.load(path), version)
+        self.snapshots[path] = snapshot
+        return snapshot
+
+    def get(self, path):
+        return self.cached(path) or self.load(path)
+
+    @staticmethod
+    def _binary_fresh(binary, version):
+        try:
+            return binary is not None and os.stat(binary).st_mtime_ns >= version[0]
+        except OSError:  # Removed by a newer version meanwhile
+            return False